@@ -0,0 +1,43 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Batch planning: strategies that set batch_size get the rooms in chunks of RoomSnapshots,
+# so they can share work between rooms. With a process pool, the chunk is passed to the
+# strategy's classify_batch in another process instead; the strategy and the snapshots are
+# pickled for that, the MatrixRoom objects are left out. The space hierarchy, if loaded, is pickled
+# once per chunk as all snapshots of a chunk share it.
+
+class RoomSnapshot:
+    def __init__(self, room, members, nick, avatar, spaces = None, hierarchy = None):
+        self.room_id = room.room_id
+        self.room_name = room.display_name
+        self.room_type = room.room_type
+        self.nick = nick
+        self.avatar = avatar
+        self.members = members
+        self.space_ids = [space if isinstance(space, str) else space.room_id for space in spaces or []]
+        # The controller's hierarchy.SpaceHierarchy, if it loads one
+        self.hierarchy = hierarchy
+        # Only available in this process
+        self.room = room
+        self.spaces = spaces
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["room"] = None
+        state["spaces"] = None
+        return state
+
+def chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def make_process_pool(processes):
+    return ProcessPoolExecutor(processes) if processes > 0 else None
+
+async def run_in_pool(pool, strategy, snapshots):
+    if not hasattr(strategy, "classify_batch"):
+        raise ValueError(f"{type(strategy).__name__} needs a classify_batch(snapshots) method to run in a process pool")
+    return await asyncio.get_event_loop().run_in_executor(pool, strategy.classify_batch, snapshots)
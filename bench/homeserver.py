@@ -0,0 +1,276 @@
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+# Minimal Matrix homeserver serving one synthetic account, just enough for the scripts in this repo.
+# Latency and rate limit responses can be injected to see how the scripts behave under load.
+class FakeHomeserver:
+    def __init__(self, rooms = 1000, spaces = 10, members_per_room = 5, bridged_rooms = 100,
+            server_name = "bench.local", latency = 0.0, rate_limit_every = 0, retry_after_ms = 100, seed = 42):
+        self.server_name = server_name
+        self.mxid = f"@bench:{server_name}"
+        self.latency = latency
+        # Every n-th write is answered with M_LIMIT_EXCEEDED, 0 to disable
+        self.rate_limit_every = rate_limit_every
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        # room id -> {(event type, state key): event}
+        self.state = dict()
+        self.space_ids = []
+        self.room_ids = []
+        # Events after the initial state, in order, as (room id, event); next_batch tokens are positions in this list
+        self.event_log = []
+        self.new_events = asyncio.Event()
+        self.event_counter = 0
+        self.write_count = 0
+        self.request_counts = dict()
+        self.bytes_sent = 0
+        self.runner = None
+        self.url = None
+        self.generate(rooms, spaces, members_per_room, bridged_rooms)
+
+    def next_event_id(self):
+        self.event_counter += 1
+        return f"$bench{self.event_counter}"
+
+    def make_event(self, room_id, event_type, state_key, content, sender = None):
+        return {
+            "type": event_type,
+            "state_key": state_key,
+            "content": content,
+            "sender": sender if sender != None else self.mxid,
+            "event_id": self.next_event_id(),
+            "origin_server_ts": int(time.time() * 1000),
+            "room_id": room_id,
+            "unsigned": {},
+        }
+
+    def set_state(self, room_id, event_type, state_key, content, sender = None):
+        event = self.make_event(room_id, event_type, state_key, content, sender)
+        self.state.setdefault(room_id, dict())[(event_type, state_key)] = event
+        return event
+
+    def generate(self, rooms, spaces, members_per_room, bridged_rooms):
+        servers = [self.server_name, "matrix.org", "example.com", "other.example"]
+        for i in range(spaces):
+            space_id = f"!space{i}:{self.server_name}"
+            self.space_ids.append(space_id)
+            self.set_state(space_id, "m.room.create", "", {"creator": self.mxid, "type": "m.space"})
+            self.set_state(space_id, "m.room.name", "", {"name": f"Space {i}"})
+            self.set_state(space_id, "m.room.member", self.mxid, {"membership": "join", "displayname": "Bench"})
+        for i in range(rooms):
+            room_id = f"!room{i}:{self.server_name}"
+            self.room_ids.append(room_id)
+            bridged = i < bridged_rooms
+            self.set_state(room_id, "m.room.create", "", {"creator": self.mxid})
+            self.set_state(room_id, "m.room.name", "", {"name": f"Room {i}"})
+            self.set_state(room_id, "m.room.member", self.mxid, {"membership": "join", "displayname": "Bench"})
+            for j in range(members_per_room):
+                server = "telegram.example" if bridged else self.random.choice(servers)
+                user_id = f"@user{i}_{j}:{server}"
+                display_name = f"User {j} (Telegram)" if bridged else f"User {j}"
+                self.set_state(room_id, "m.room.member", user_id, {"membership": "join", "displayname": display_name}, sender = user_id)
+            if bridged:
+                self.set_state(room_id, "m.bridge", f"telegram/{i}", {"bridgebot": "@telegrambot:telegram.example", "protocol": {"id": "telegram"}})
+            # Put about half of the rooms into some space already
+            if spaces > 0 and self.random.random() < 0.5:
+                space_id = self.random.choice(self.space_ids)
+                self.set_state(space_id, "m.space.child", room_id, {"via": [self.server_name]})
+
+    def inject_member_events(self, count, rooms = None):
+        # Live events: new members joining random rooms (or the given rooms)
+        # Returns the set of affected rooms
+        rooms = rooms if rooms != None else self.room_ids
+        affected_rooms = set()
+        for i in range(count):
+            room_id = self.random.choice(rooms)
+            user_id = f"@joiner{self.event_counter}:example.com"
+            event = self.set_state(room_id, "m.room.member", user_id, {"membership": "join", "displayname": f"Joiner {i}"}, sender = user_id)
+            self.event_log.append((room_id, event))
+            affected_rooms.add(room_id)
+        self.new_events.set()
+        return affected_rooms
+
+    # HTTP handling
+
+    def json_response(self, data, status = 200):
+        body = json.dumps(data).encode()
+        self.bytes_sent += len(body)
+        return web.Response(body = body, status = status, content_type = "application/json")
+
+    def error(self, errcode, message, status, **kwargs):
+        return self.json_response(dict(errcode = errcode, error = message, **kwargs), status = status)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        name = f"{request.method} {handler.__name__[len('handle_'):]}"
+        self.request_counts[name] = self.request_counts.get(name, 0) + 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    def joined_rooms(self):
+        return self.space_ids + self.room_ids
+
+    def room_sync(self, room_id, state_events, timeline_events):
+        joined_count = sum(1 for (event_type, _), event in self.state[room_id].items() if event_type == "m.room.member" and event["content"].get("membership") == "join")
+        return {
+            "summary": {"m.joined_member_count": joined_count, "m.invited_member_count": 0},
+            "state": {"events": state_events},
+            "timeline": {"events": timeline_events, "limited": False, "prev_batch": "p0"},
+            "ephemeral": {"events": []},
+            "account_data": {"events": []},
+            "unread_notifications": {"highlight_count": 0, "notification_count": 0},
+        }
+
+    async def handle_sync(self, request):
+        since = request.query.get("since")
+        join = dict()
+        if since == None:
+            for room_id in self.joined_rooms():
+                join[room_id] = self.room_sync(room_id, list(self.state[room_id].values()), [])
+        else:
+            position = int(since)
+            timeout = int(request.query.get("timeout", "0")) / 1000
+            if position >= len(self.event_log) and timeout > 0:
+                self.new_events.clear()
+                try:
+                    await asyncio.wait_for(self.new_events.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            for room_id, event in self.event_log[position:]:
+                if room_id not in join:
+                    join[room_id] = self.room_sync(room_id, [], [])
+                join[room_id]["timeline"]["events"].append(event)
+        return self.json_response({
+            "next_batch": str(len(self.event_log)),
+            "rooms": {"join": join, "invite": {}, "leave": {}},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+            "to_device": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {},
+        })
+
+    async def handle_login(self, request):
+        return self.json_response({"user_id": self.mxid, "access_token": "bench-token", "device_id": "BENCH"})
+
+    async def handle_logout(self, request):
+        return self.json_response({})
+
+    async def handle_filter(self, request):
+        return self.json_response({"filter_id": "1"})
+
+    async def handle_joined_rooms(self, request):
+        return self.json_response({"joined_rooms": self.joined_rooms()})
+
+    async def handle_joined_members(self, request):
+        room_id = request.match_info["room_id"]
+        if room_id not in self.state:
+            return self.error("M_FORBIDDEN", "Not in room", 403)
+        joined = dict()
+        for (event_type, state_key), event in self.state[room_id].items():
+            if event_type == "m.room.member" and event["content"].get("membership") == "join":
+                joined[state_key] = {"display_name": event["content"].get("displayname"), "avatar_url": event["content"].get("avatar_url")}
+        return self.json_response({"joined": joined})
+
+    async def handle_state(self, request):
+        room_id = request.match_info["room_id"]
+        if room_id not in self.state:
+            return self.error("M_FORBIDDEN", "Not in room", 403)
+        return self.json_response(list(self.state[room_id].values()))
+
+    async def handle_state_event(self, request):
+        room_id = request.match_info["room_id"]
+        key = (request.match_info["event_type"], request.match_info.get("state_key", ""))
+        if room_id not in self.state:
+            return self.error("M_FORBIDDEN", "Not in room", 403)
+        if request.method == "GET":
+            if key not in self.state[room_id]:
+                return self.error("M_NOT_FOUND", "Event not found", 404)
+            return self.json_response(self.state[room_id][key]["content"])
+        self.write_count += 1
+        if self.rate_limit_every > 0 and self.write_count % self.rate_limit_every == 0:
+            return self.error("M_LIMIT_EXCEEDED", "Too many requests", 429, retry_after_ms = self.retry_after_ms)
+        content = await request.json()
+        event = self.set_state(room_id, key[0], key[1], content)
+        self.event_log.append((room_id, event))
+        self.new_events.set()
+        return self.json_response({"event_id": event["event_id"]})
+
+    async def handle_hierarchy(self, request):
+        # Breadth first walk below the room, paginated by position in the walk
+        room_id = request.match_info["room_id"]
+        if room_id not in self.state:
+            return self.error("M_FORBIDDEN", "Not in room", 403)
+        limit = int(request.query.get("limit", "50"))
+        start = int(request.query.get("from", "0"))
+        walk = [room_id]
+        visited = {room_id}
+        index = 0
+        while index < len(walk) and len(walk) < start + limit + 1:
+            for (event_type, state_key), event in self.state.get(walk[index], {}).items():
+                if event_type == "m.space.child" and len(event["content"]) > 0 and state_key not in visited and state_key in self.state:
+                    visited.add(state_key)
+                    walk.append(state_key)
+            index += 1
+        rooms = []
+        for child_id in walk[start:start + limit]:
+            create = self.state[child_id].get(("m.room.create", ""))
+            name = self.state[child_id].get(("m.room.name", ""))
+            summary = {
+                "room_id": child_id,
+                "room_type": create["content"].get("type") if create != None else None,
+                "name": name["content"].get("name") if name != None else None,
+                "num_joined_members": 1,
+                "world_readable": False,
+                "guest_can_join": False,
+                "children_state": [],
+            }
+            if summary["room_type"] == "m.space":
+                summary["children_state"] = [
+                    {"type": event_type, "state_key": state_key, "content": event["content"], "sender": event["sender"], "origin_server_ts": event["origin_server_ts"]}
+                    for (event_type, state_key), event in self.state[child_id].items() if event_type == "m.space.child"
+                ]
+            rooms.append(summary)
+        result = {"rooms": rooms}
+        if len(walk) > start + limit:
+            result["next_batch"] = str(start + limit)
+        return self.json_response(result)
+
+    def make_app(self):
+        app = web.Application(middlewares = [self.middleware])
+        prefix = "/_matrix/client/{version}"
+        app.router.add_post(prefix + "/login", self.handle_login)
+        app.router.add_post(prefix + "/logout", self.handle_logout)
+        app.router.add_get(prefix + "/sync", self.handle_sync)
+        app.router.add_post(prefix + "/user/{user_id}/filter", self.handle_filter)
+        app.router.add_get(prefix + "/joined_rooms", self.handle_joined_rooms)
+        app.router.add_get(prefix + "/rooms/{room_id}/joined_members", self.handle_joined_members)
+        app.router.add_get(prefix + "/rooms/{room_id}/state", self.handle_state)
+        app.router.add_get(prefix + "/rooms/{room_id}/hierarchy", self.handle_hierarchy)
+        app.router.add_route("*", prefix + "/rooms/{room_id}/state/{event_type}", self.handle_state_event)
+        app.router.add_route("*", prefix + "/rooms/{room_id}/state/{event_type}/{state_key:.*}", self.handle_state_event)
+        return app
+
+    async def start(self, host = "127.0.0.1", port = 0):
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        # Wake up pending long polls
+        self.new_events.set()
+        await self.runner.cleanup()
+
+    def reset_counters(self):
+        self.request_counts = dict()
+        self.bytes_sent = 0
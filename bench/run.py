@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks of the renamer and space management against a local fake homeserver.
+# Like the other scripts it uses relative imports, so run it as a module of the package this
+# repository is checked out as, e.g. if checked out as "selforg":
+#   python -m selforg.bench.run --scale 10k --latency 0.005
+# Every scenario prints one JSON line with wall time, requests per endpoint, peak memory and phase timings.
+#
+
+import argparse
+import asyncio
+import builtins
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+import zlib
+
+from .homeserver import FakeHomeserver
+from ..renamer import exec_rename, Strategy
+from ..roomspace import RoomSpaceController, SpaceStrategy
+from ..metrics import RunMetrics
+
+
+SCALES = {
+    "1k": 1000,
+    "10k": 10000,
+    "50k": 50000,
+}
+
+class BenchRenameStrategy(Strategy):
+    async def get_new_name_and_avatar(self, client, myroomnick, myavatarurl, room, members):
+        for member in members:
+            if " (Telegram)" in (member.display_name or ""):
+                return "Bench (Telegram)", myavatarurl
+        return "Bench", myavatarurl
+
+class BenchSpaceStrategy(SpaceStrategy):
+    def __init__(self, space_ids, server_name):
+        self.space_ids = space_ids
+        self.server_name = server_name
+    async def get_new_spaces(self, client, myroomnick, myavatarurl, room, members, previous_spaces, hierarchy = None):
+        if len(self.space_ids) == 0:
+            return []
+        return [self.space_ids[zlib.crc32(room.room_id.encode()) % len(self.space_ids)]]
+    def get_via_for_room(self, room):
+        return [self.server_name]
+
+@contextlib.contextmanager
+def unattended(quiet):
+    # The scripts ask for confirmation before writing and print a lot
+    original_input = builtins.input
+    builtins.input = lambda prompt = "": ""
+    try:
+        if quiet:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                yield
+        else:
+            yield
+    finally:
+        builtins.input = original_input
+
+async def measure(name, server, run, quiet):
+    server.reset_counters()
+    metrics = RunMetrics(name)
+    tracemalloc.start()
+    start = time.monotonic()
+    try:
+        with unattended(quiet):
+            extra = await run(metrics)
+    finally:
+        wall_time = time.monotonic() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    result = {
+        "scenario": name,
+        "wall_time": round(wall_time, 3),
+        "requests": dict(sorted(server.request_counts.items())),
+        "request_total": sum(server.request_counts.values()),
+        "bytes_sent": server.bytes_sent,
+        "peak_memory": peak,
+        "phases": {phase: round(histogram.total, 3) for phase, histogram in metrics.phases.items()},
+    }
+    if extra != None:
+        result.update(extra)
+    return result
+
+async def bench_rename(server, args):
+    async def run(metrics):
+        await exec_rename(BenchRenameStrategy(), server.url, server.mxid, passwd = "bench",
+                planning_concurrency = args.concurrency, metrics = metrics)
+    return await measure("rename", server, run, args.quiet)
+
+async def bench_space(server, args):
+    async def run(metrics):
+        strategy = BenchSpaceStrategy(server.space_ids, server.server_name)
+        controller = RoomSpaceController(strategy, server.url, server.mxid, passwd = "bench",
+                space_fetch_concurrency = args.concurrency, load_space_hierarchy = args.hierarchy, metrics = metrics)
+        await controller.exec_space_manage(initial = True, ongoing = False)
+    return await measure("space", server, run, args.quiet)
+
+async def bench_live(server, args):
+    async def run(metrics):
+        strategy = BenchSpaceStrategy(server.space_ids, server.server_name)
+        controller = RoomSpaceController(strategy, server.url, server.mxid, passwd = "bench",
+                space_fetch_concurrency = args.concurrency, debounce_seconds = args.debounce, metrics = metrics)
+        task = asyncio.ensure_future(controller.exec_space_manage(initial = False, ongoing = True))
+        try:
+            # Wait until the controller is long-polling
+            while server.request_counts.get("GET sync", 0) < 2:
+                if task.done():
+                    task.result()
+                await asyncio.sleep(0.05)
+            rooms = server.random.sample(server.room_ids, min(args.event_rooms, len(server.room_ids)))
+            start = time.monotonic()
+            affected_rooms = server.inject_member_events(args.events, rooms)
+            deadline = start + args.live_timeout
+            while time.monotonic() < deadline:
+                updates = metrics.phases.get("live_update")
+                if updates != None and updates.count >= len(affected_rooms):
+                    break
+                await asyncio.sleep(0.01)
+            live_time = time.monotonic() - start
+            updates = metrics.phases.get("live_update")
+            return {
+                "events": args.events,
+                "affected_rooms": len(affected_rooms),
+                "room_updates": updates.count if updates != None else 0,
+                "live_time": round(live_time, 3),
+            }
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions = True)
+    return await measure("live", server, run, args.quiet)
+
+SCENARIOS = {
+    "rename": bench_rename,
+    "space": bench_space,
+    "live": bench_live,
+}
+
+async def main(args):
+    rooms = SCALES[args.scale] if args.scale != None else args.rooms
+    spaces = args.spaces if args.spaces != None else max(1, rooms // 50)
+    bridged_rooms = args.bridged if args.bridged != None else rooms // 10
+    scenarios = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    results = []
+    for scenario in scenarios:
+        # Fresh server per scenario, so writes of one scenario do not change the next
+        server = FakeHomeserver(rooms = rooms, spaces = spaces, members_per_room = args.members, bridged_rooms = bridged_rooms,
+                latency = args.latency, rate_limit_every = args.rate_limit_every, retry_after_ms = args.retry_after_ms)
+        await server.start()
+        try:
+            result = await SCENARIOS[scenario](server, args)
+        finally:
+            await server.stop()
+        result.update({"rooms": rooms, "spaces": spaces, "members_per_room": args.members, "bridged_rooms": bridged_rooms})
+        print(json.dumps(result))
+        results.append(result)
+    if args.output != None:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark against a fake homeserver")
+    parser.add_argument("--scenario", choices = list(SCENARIOS) + ["all"], default = "all")
+    parser.add_argument("--scale", choices = list(SCALES), help = "Number of rooms, overrides --rooms")
+    parser.add_argument("--rooms", type = int, default = 1000)
+    parser.add_argument("--spaces", type = int, help = "Default: one per 50 rooms")
+    parser.add_argument("--members", type = int, default = 5, help = "Members per room besides us")
+    parser.add_argument("--bridged", type = int, help = "Bridged rooms, default: 10%% of rooms")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "Seconds added to every request")
+    parser.add_argument("--rate-limit-every", type = int, default = 0, help = "Answer every n-th write with M_LIMIT_EXCEEDED")
+    parser.add_argument("--retry-after-ms", type = int, default = 100)
+    parser.add_argument("--concurrency", type = int, default = 8)
+    parser.add_argument("--events", type = int, default = 200, help = "Live events in the burst")
+    parser.add_argument("--event-rooms", type = int, default = 20, help = "Rooms the live events go to")
+    parser.add_argument("--hierarchy", action = "store_true", help = "Load the space hierarchy in the space scenario")
+    parser.add_argument("--debounce", type = float, default = 0.5)
+    parser.add_argument("--live-timeout", type = float, default = 120)
+    parser.add_argument("--output", help = "Append results as JSON lines to this file")
+    parser.add_argument("--verbose", dest = "quiet", action = "store_false", help = "Show output of the scripts")
+    asyncio.get_event_loop().run_until_complete(main(parser.parse_args()))
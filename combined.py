@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+from .roomspace import RoomSpaceController, is_space
+from .renamer import rename_content, start_room_rename, decide_room_rename, decide_rooms_rename
+from .decisioncache import DecisionCache
+from .metrics import RunMetrics
+from .batch import make_process_pool
+
+
+# Renaming and space management in one run: one login, one sync and one member list per room,
+# which both a renamer.Strategy and a roomspace.SpaceStrategy decide on.
+# Space rooms are renamed too, but never added to spaces.
+# Further keyword arguments are passed to RoomSpaceController.
+class CombinedController(RoomSpaceController):
+    def __init__(self, rename_strategy, space_strategy, homeserver, mxid, metrics = None, **options):
+        if metrics == None:
+            metrics = RunMetrics("combined")
+        super().__init__(space_strategy, homeserver, mxid, metrics = metrics, **options)
+        self.rename_strategy = rename_strategy
+        # Decisions of the two strategies depend on different inputs, so they are cached apart
+        self.rename_decision_cache = DecisionCache(self.decision_cache.maxsize) if self.decision_cache != None else None
+        # Renames planned by handle_room for the initial pass, until they are printed and executed
+        self.planned_renames = []
+        self.planned_rename_count = 0
+        # Like self.pool, for a rename strategy with a batch_size
+        self.rename_pool = None
+
+    async def exec_space_manage(self, *args, **kwargs):
+        if self.rename_strategy.batch_size != None:
+            self.rename_pool = make_process_pool(self.batch_processes)
+        try:
+            await super().exec_space_manage(*args, **kwargs)
+        finally:
+            if self.rename_pool != None:
+                self.rename_pool.shutdown()
+                self.rename_pool = None
+
+    async def plan_room(self, room):
+        # Returns the rename report lines, the planned rename or None, planned additions and planned removals
+        report, rename_allowed = start_room_rename(self.rename_strategy, self.mxid, room)
+        if not rename_allowed and is_space(room):
+            return report, None, [], []
+        with self.metrics.phase("members"):
+            members = await self.member_source.get_members(self.client, room)
+        planned_rename = None
+        if rename_allowed and self.rename_strategy.batch_size != None:
+            # Batch strategies may only implement get_new_names_and_avatars or classify_batch, so decide a chunk of one
+            decided = await decide_rooms_rename(self.client, self.rename_strategy, self.mxid, [room], [members], [report], self.rename_decision_cache, self.metrics, self.rename_pool)
+            report, planned_rename = decided[0]
+        elif rename_allowed:
+            report, planned_rename = await decide_room_rename(self.client, self.rename_strategy, self.mxid, room, members, report, self.rename_decision_cache, self.metrics)
+        snapshot = await self.snapshot_room(room, members)
+        if snapshot == None:
+            return report, planned_rename, [], []
+        planned_additions, planned_removals = await self.decide_spaces(snapshot)
+        return report, planned_rename, planned_additions, planned_removals
+
+    async def handle_room(self, room):
+        # Initial pass of RoomSpaceController.exec_space_manage, renames are kept until exec_planned_changes
+        report, planned_rename, planned_additions, planned_removals = await self.plan_room(room)
+        for line in report:
+            print(line)
+        if planned_rename != None:
+            self.planned_renames.append(planned_rename)
+            self.planned_rename_count += 1
+            self.metrics.set_value("planned_renames", self.planned_rename_count)
+        return planned_additions, planned_removals
+
+    async def handle_rooms(self, rooms):
+        # Batches of the space strategy are not combined with renames, plan room by room
+        # (decide_spaces still asks a batch strategy, with chunks of one room)
+        planned_additions = []
+        planned_removals = []
+        for room in rooms:
+            pa, pr = await self.handle_room(room)
+            planned_additions += pa
+            planned_removals += pr
+        return planned_additions, planned_removals
+
+    def print_planned_renames(self, planned_renames):
+        print("Planned renames:")
+        for pr in planned_renames:
+            print(f"{pr.room_name} |{pr.old_name}|{pr.old_avatar} -> {pr.new_name}|{pr.new_avatar}")
+
+    async def print_planned_changes(self, planned_additions, planned_removals):
+        self.print_planned_renames(self.planned_renames)
+        await super().print_planned_changes(planned_additions, planned_removals)
+
+    def write_planned_changes(self, plan_writer, planned_additions, planned_removals):
+        for pr in self.planned_renames:
+            plan_writer.add_state_change("rename", pr.room_id, "m.room.member", self.mxid, rename_content(pr), pr.room_name)
+        self.planned_renames = []
+        super().write_planned_changes(plan_writer, planned_additions, planned_removals)
+
+    async def exec_planned_changes(self, planned_additions, planned_removals):
+        planned_renames = self.planned_renames
+        self.planned_renames = []
+        await self.exec_changes(planned_renames, planned_additions, planned_removals)
+
+    async def exec_changes(self, planned_renames, planned_additions, planned_removals):
+        tasks = []
+        for pr in planned_renames:
+            content = rename_content(pr)
+            print(f"{pr.room_name}: {content}")
+            tasks.append(self.writer.put_state(room_id = pr.room_id, event_type = "m.room.member", content = content, state_key = self.mxid, label = pr.room_name))
+        if len(tasks) > 0 and len(planned_additions) == 0 and len(planned_removals) == 0:
+            # Nothing for the space changes to wait for, so wait here
+            with self.metrics.phase("writes"):
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.report_writes(tasks)
+            return
+        await RoomSpaceController.exec_planned_changes(self, planned_additions, planned_removals)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if len(tasks) > 0:
+            self.report_writes(tasks)
+
+    async def update_room(self, room):
+        # Live and queued updates plan and execute one room at a time, without the initial pass' state
+        report, planned_rename, planned_additions, planned_removals = await self.plan_room(room)
+        if planned_rename == None and len(planned_additions) == 0 and len(planned_removals) == 0:
+            return
+        for line in report:
+            print(line)
+        planned_renames = [planned_rename] if planned_rename != None else []
+        print("-"*42)
+        self.print_planned_renames(planned_renames)
+        await RoomSpaceController.print_planned_changes(self, planned_additions, planned_removals)
+        print("-"*42)
+        await self.exec_changes(planned_renames, planned_additions, planned_removals)
+
+def manage(rename_strategy, space_strategy, homeserver, mxid, passwd = None, token = None, initial = True, ongoing = False, confirm = True, plan_path = None, **options):
+    controller = CombinedController(rename_strategy, space_strategy, homeserver, mxid, passwd = passwd, token = token, **options)
+    asyncio.get_event_loop().run_until_complete(controller.exec_space_manage(initial = initial, ongoing = ongoing, confirm = confirm, plan_path = plan_path))
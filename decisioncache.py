@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+
+# Inputs a strategy can declare in its decision_inputs to make its decisions cacheable:
+# - room_id: the room itself, for strategies that look up anything else about the room
+# - room_type: m.room.create type of the room
+# - member_ids: user ids of joined members
+# - member_names: user ids and display names of joined members
+# - nick, avatar: our own current room nick and avatar
+# - spaces: ids of the spaces the room is currently in
+DECISION_INPUTS = ["room_id", "room_type", "member_ids", "member_names", "nick", "avatar", "spaces"]
+
+def decision_fingerprint(inputs, room, members, myroomnick, myavatarurl, spaces = None):
+    fingerprint = []
+    for name in inputs:
+        if name == "room_id":
+            fingerprint.append(room.room_id)
+        elif name == "room_type":
+            fingerprint.append(room.room_type)
+        elif name == "member_ids":
+            fingerprint.append(tuple(sorted(member.user_id for member in members)))
+        elif name == "member_names":
+            fingerprint.append(tuple(sorted((member.user_id, member.display_name or "") for member in members)))
+        elif name == "nick":
+            fingerprint.append(myroomnick)
+        elif name == "avatar":
+            fingerprint.append(myavatarurl)
+        elif name == "spaces":
+            fingerprint.append(tuple(sorted(space if isinstance(space, str) else space.room_id for space in spaces or [])))
+        else:
+            raise ValueError(f"Unknown decision input {name}, expected one of {DECISION_INPUTS}")
+    return tuple(fingerprint)
+
+# Bounded LRU cache of strategy decisions by input fingerprint
+class DecisionCache:
+    def __init__(self, maxsize = 4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # Returns whether there was a cached decision, and the decision
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, decision):
+        self.entries[key] = decision
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def print_summary(self):
+        print(f"Decision cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions, {len(self.entries)} cached")
@@ -57,6 +57,10 @@ MANAGED_AVATARS = [
 ]
 
 class SeppStrategy(KeepUnknownStrategy):
+    # Our choice only depends on who is in the room and how they are named,
+    # so rooms with the same members can reuse the decision.
+    decision_inputs = ["member_names"]
+
     def __init__(self):
         # KeepUnknownStrategy: this strategy will not change display names that have not been added to MANAGED_DISPLAY_NAMES,
         # and avatars not added to MANAGED_AVATARS.
@@ -0,0 +1,185 @@
+import time
+from urllib.parse import quote, urlencode
+
+from .util import bounded_map
+
+
+# Parent/child graph of nested spaces, including sub-spaces we have not joined.
+# Loaded with the paginated /hierarchy endpoint and updated per m.space.child event.
+# Ancestor queries are memoized; an edge change only drops the memo of the child and its descendants.
+class SpaceHierarchy:
+    def __init__(self):
+        # space id -> set of child room ids
+        self.children = dict()
+        # room id -> set of parent space ids
+        self.parents = dict()
+        # room id -> room summary from /hierarchy (name, room_type, ...)
+        self.rooms = dict()
+        # room id -> frozenset of ancestor space ids
+        self.ancestor_cache = dict()
+        # (space id, room id) edges that closed a cycle when they were added
+        self.cycle_edges = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.children)
+
+    def add_room(self, summary):
+        self.rooms[summary["room_id"]] = summary
+
+    def is_space(self, room_id):
+        summary = self.rooms.get(room_id)
+        if summary != None and summary.get("room_type") == "m.space":
+            return True
+        return room_id in self.children
+
+    def add_child(self, space_id, room_id):
+        # Returns whether the graph changed
+        children = self.children.setdefault(space_id, set())
+        if room_id in children:
+            return False
+        if room_id == space_id or room_id in self.get_ancestors(space_id):
+            # Cycles are possible in Matrix, the graph keeps the edge but walks never visit a room twice
+            self.cycle_edges.add((space_id, room_id))
+            print(f"Space cycle: {room_id} is also an ancestor of {space_id}")
+        self._invalidate(room_id)
+        children.add(room_id)
+        self.parents.setdefault(room_id, set()).add(space_id)
+        return True
+
+    def remove_child(self, space_id, room_id):
+        # Returns whether the graph changed
+        children = self.children.get(space_id)
+        if children == None or room_id not in children:
+            return False
+        self._invalidate(room_id)
+        children.remove(room_id)
+        self.cycle_edges.discard((space_id, room_id))
+        parents = self.parents.get(room_id)
+        parents.discard(space_id)
+        if len(parents) == 0:
+            del self.parents[room_id]
+        return True
+
+    def set_children(self, space_id, room_ids):
+        room_ids = set(room_ids)
+        old_room_ids = set(self.children.get(space_id, set()))
+        for room_id in old_room_ids - room_ids:
+            self.remove_child(space_id, room_id)
+        for room_id in room_ids - old_room_ids:
+            self.add_child(space_id, room_id)
+        self.children.setdefault(space_id, set())
+
+    def get_children(self, space_id):
+        return self.children.get(space_id, set())
+
+    def get_parents(self, room_id):
+        return self.parents.get(room_id, set())
+
+    def get_ancestors(self, room_id):
+        # All spaces room_id is in, directly or through sub-spaces
+        ancestors = self.ancestor_cache.get(room_id)
+        if ancestors != None:
+            self.hits += 1
+            return ancestors
+        self.misses += 1
+        ancestors = set()
+        stack = list(self.parents.get(room_id, ()))
+        while len(stack) > 0:
+            space_id = stack.pop()
+            if space_id in ancestors:
+                continue
+            ancestors.add(space_id)
+            known = self.ancestor_cache.get(space_id)
+            if known != None:
+                # Already complete, no need to walk further up from here
+                ancestors |= known
+                continue
+            stack.extend(self.parents.get(space_id, ()))
+        ancestors.discard(room_id)
+        ancestors = frozenset(ancestors)
+        self.ancestor_cache[room_id] = ancestors
+        return ancestors
+
+    def get_descendants(self, space_id):
+        descendants = set()
+        stack = list(self.children.get(space_id, ()))
+        while len(stack) > 0:
+            room_id = stack.pop()
+            if room_id in descendants:
+                continue
+            descendants.add(room_id)
+            stack.extend(self.children.get(room_id, ()))
+        descendants.discard(space_id)
+        return descendants
+
+    def get_root_spaces(self, room_ids):
+        # Spaces among room_ids without a parent among room_ids
+        room_ids = set(room_ids)
+        return [room_id for room_id in room_ids if len(self.get_parents(room_id) & room_ids) == 0]
+
+    def _invalidate(self, room_id):
+        # The ancestors of room_id and of everything below it depend on its parents
+        if len(self.ancestor_cache) == 0:
+            return
+        self.ancestor_cache.pop(room_id, None)
+        for descendant in self.get_descendants(room_id):
+            self.ancestor_cache.pop(descendant, None)
+
+    def print_summary(self):
+        edges = sum(len(children) for children in self.children.values())
+        print(f"Space hierarchy: {len(self.children)} spaces, {edges} edges, {len(self.cycle_edges)} cycles, ancestor queries: {self.hits} cached, {self.misses} computed")
+
+async def fetch_hierarchy_page(client, room_id, from_token = None, limit = 50, metrics = None):
+    # One page of GET /_matrix/client/v1/rooms/{roomId}/hierarchy
+    # https://spec.matrix.org/v1.2/client-server-api/#get_matrixclientv1roomsroomidhierarchy
+    query = {"limit": limit}
+    if from_token != None:
+        query["from"] = from_token
+    path = f"/_matrix/client/v1/rooms/{quote(room_id, safe='')}/hierarchy?{urlencode(query)}"
+    start = time.monotonic()
+    response = await client.send("GET", path, headers = {"Authorization": f"Bearer {client.access_token}"})
+    body = await response.read()
+    if metrics != None:
+        metrics.record_request("hierarchy", time.monotonic() - start, len(body), response.status != 200)
+    if response.status != 200:
+        raise RuntimeError(f"Could not get hierarchy of {room_id}: {response.status} {body[:200]}")
+    return await response.json()
+
+async def load_hierarchy(client, hierarchy, root_id, page_size = 50, metrics = None):
+    # Adds all rooms below root_id the server tells us about, returns the number of rooms seen
+    seen = 0
+    from_token = None
+    while True:
+        page = await fetch_hierarchy_page(client, root_id, from_token, page_size, metrics)
+        for summary in page.get("rooms", []):
+            children_state = summary.pop("children_state", [])
+            hierarchy.add_room(summary)
+            seen += 1
+            if summary.get("room_type") == "m.space":
+                hierarchy.set_children(summary["room_id"], [
+                    event["state_key"] for event in children_state
+                    if event.get("type") == "m.space.child" and len(event.get("content") or {}) > 0
+                ])
+        from_token = page.get("next_batch")
+        if from_token == None:
+            return seen
+
+async def load_hierarchies(client, hierarchy, space_ids, concurrency = 8, page_size = 50, metrics = None):
+    # Only the top-level spaces are requested, their hierarchies contain the sub-spaces.
+    # Joined spaces not reachable from those (e.g. hidden from the server's walk) get a request of their own.
+    space_ids = list(space_ids)
+    roots = hierarchy.get_root_spaces(space_ids)
+    async def load(space_id):
+        try:
+            return await load_hierarchy(client, hierarchy, space_id, page_size, metrics)
+        except Exception as e:
+            print(f"Failed to load hierarchy of {space_id}: {e}")
+            return 0
+    async for _ in bounded_map(load, roots, concurrency):
+        pass
+    missing = [space_id for space_id in space_ids if space_id not in hierarchy.rooms]
+    async for _ in bounded_map(load, missing, concurrency):
+        pass
+    return len(roots) + len(missing)
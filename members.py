@@ -0,0 +1,62 @@
+import importlib
+
+from .util import client_package
+
+
+# Where member lists for strategies come from:
+# - local: the members nio knows from sync
+# - remote: a joined_members request per room
+# - hybrid: local members if the room's member list is complete, remote otherwise
+MEMBER_SOURCE_MODES = ["local", "remote", "hybrid"]
+
+def member_class(client):
+    # RoomMember of nio or mnio, like the client's joined_members responses
+    return importlib.import_module(client_package(client).__name__ + ".responses").RoomMember
+
+class MemberSource:
+    def __init__(self, mode = "hybrid", store = None):
+        if mode not in MEMBER_SOURCE_MODES:
+            raise ValueError(f"Unknown member source {mode}, expected one of {MEMBER_SOURCE_MODES}")
+        self.mode = mode
+        # Optional SyncStore to reuse fetched members of rooms that did not change since the last run
+        self.store = store
+        self.local_count = 0
+        self.stored_count = 0
+        self.remote_count = 0
+
+    def local_members(self, client, room):
+        # Same objects as in a joined_members response, without invited users
+        RoomMember = member_class(client)
+        invited_users = getattr(room, "invited_users", dict())
+        return [
+            RoomMember(user.user_id, user.display_name, user.avatar_url)
+            for user_id, user in room.users.items()
+            if user_id not in invited_users
+        ]
+
+    def members_complete(self, room):
+        if getattr(room, "members_synced", False):
+            return True
+        summary = getattr(room, "summary", None)
+        joined_member_count = getattr(summary, "joined_member_count", None)
+        if joined_member_count != None:
+            return joined_member_count == len(room.users) - len(getattr(room, "invited_users", dict()))
+        return True
+
+    async def get_members(self, client, room):
+        if self.mode == "local" or (self.mode == "hybrid" and self.members_complete(room)):
+            self.local_count += 1
+            return self.local_members(client, room)
+        if self.store != None and not self.store.room_changed(room.room_id):
+            members = self.store.load_members(room.room_id, member_class(client))
+            if members != None:
+                self.stored_count += 1
+                return members
+        self.remote_count += 1
+        member_response = await client.joined_members(room_id = room.room_id)
+        if self.store != None:
+            self.store.save_members(room.room_id, member_response.members)
+        return member_response.members
+
+    def print_summary(self):
+        print(f"Members: {self.local_count} rooms from sync, {self.stored_count} from store, {self.remote_count} fetched")
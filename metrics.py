@@ -0,0 +1,174 @@
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket takes everything above
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Client methods that are counted per endpoint by RunMetrics.instrument_client
+INSTRUMENTED_METHODS = [
+    "login",
+    "sync",
+    "upload_filter",
+    "joined_rooms",
+    "joined_members",
+    "room_get_state",
+    "room_get_state_event",
+    "room_put_state",
+]
+
+class Histogram:
+    def __init__(self, buckets = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count > 0 else 0,
+            "max": self.max,
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ["inf"], self.counts)},
+        }
+
+# Per-phase timings, per-endpoint request statistics and counters of a run.
+# Hooks are called as hook(kind, name, value) for every recorded value, with kind one of
+# "phase", "request", "counter", "value" or "report", to forward metrics to other monitoring.
+class RunMetrics:
+    def __init__(self, name = ""):
+        self.name = name
+        self.started = time.time()
+        self.start_time = time.monotonic()
+        self.phases = dict()
+        self.requests = dict()
+        self.counters = dict()
+        self.values = dict()
+        self.hooks = []
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def _run_hooks(self, kind, name, value):
+        for hook in self.hooks:
+            try:
+                hook(kind, name, value)
+            except Exception as e:
+                print(f"Metrics hook failed: {e}")
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.monotonic() - start)
+
+    def record_phase(self, name, duration):
+        if name not in self.phases:
+            self.phases[name] = Histogram()
+        self.phases[name].observe(duration)
+        self._run_hooks("phase", name, duration)
+
+    def record_request(self, endpoint, duration, bytes_received, error):
+        if endpoint not in self.requests:
+            self.requests[endpoint] = {"count": 0, "errors": 0, "bytes_received": 0, "latency": Histogram()}
+        stats = self.requests[endpoint]
+        stats["count"] += 1
+        stats["bytes_received"] += bytes_received
+        if error:
+            stats["errors"] += 1
+        stats["latency"].observe(duration)
+        self._run_hooks("request", endpoint, duration)
+
+    def count(self, name, value = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self._run_hooks("counter", name, value)
+
+    def set_value(self, name, value):
+        self.values[name] = value
+        self._run_hooks("value", name, value)
+
+    def record_planning(self, member_source, decision_cache):
+        # Where members came from and how often decisions were reused
+        self.set_value("members_local", member_source.local_count)
+        self.set_value("members_stored", member_source.stored_count)
+        self.set_value("members_fetched", member_source.remote_count)
+        if decision_cache != None:
+            self.set_value("decision_cache_hits", decision_cache.hits)
+            self.set_value("decision_cache_misses", decision_cache.misses)
+
+    def record_writer(self, writer):
+        self.set_value("writes_succeeded", writer.succeeded)
+        self.set_value("writes_retried", writer.retried)
+        self.set_value("writes_failed", writer.failed)
+
+    def instrument_client(self, client):
+        for method_name in INSTRUMENTED_METHODS:
+            method = getattr(client, method_name, None)
+            if method != None:
+                setattr(client, method_name, self._wrap_method(method_name, method))
+        return client
+
+    def _wrap_method(self, endpoint, method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                response = await method(*args, **kwargs)
+            except Exception:
+                self.record_request(endpoint, time.monotonic() - start, 0, True)
+                raise
+            error = type(response).__name__.endswith("Error")
+            self.record_request(endpoint, time.monotonic() - start, response_size(response), error)
+            return response
+        return wrapper
+
+    def report(self):
+        return {
+            "name": self.name,
+            "started": self.started,
+            "duration": time.monotonic() - self.start_time,
+            "phases": {name: histogram.as_dict() for name, histogram in self.phases.items()},
+            "requests": {
+                endpoint: {
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "bytes_received": stats["bytes_received"],
+                    "latency": stats["latency"].as_dict(),
+                }
+                for endpoint, stats in self.requests.items()
+            },
+            "counters": self.counters,
+            "values": self.values,
+        }
+
+    def write_report(self, path):
+        report = self.report()
+        self._run_hooks("report", self.name, report)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote run report to {path}")
+
+def response_size(response):
+    # Bytes of the HTTP body the response was parsed from, if known
+    transport_response = getattr(response, "transport_response", None)
+    if transport_response == None:
+        return 0
+    if transport_response.content_length != None:
+        return transport_response.content_length
+    body = getattr(transport_response, "_body", None)
+    return len(body) if body != None else 0
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import asyncio
+import time
+import traceback
+
+import aiohttp
+
+from .renamer import exec_rename
+from .roomspace import RoomSpaceController
+from .metrics import RunMetrics
+
+
+# One account to process, kind is "rename" (strategy is a renamer.Strategy)
+# or "space" (strategy is a roomspace.SpaceStrategy).
+# Further keyword arguments are passed to exec_rename or RoomSpaceController.
+class AccountJob:
+    def __init__(self, kind, strategy, homeserver, mxid, passwd = None, token = None, name = None, initial = True, ongoing = False, **options):
+        if kind not in ["rename", "space"]:
+            raise ValueError(f"Unknown job kind {kind}")
+        self.kind = kind
+        self.strategy = strategy
+        self.homeserver = homeserver
+        self.mxid = mxid
+        self.passwd = passwd
+        self.token = token
+        self.name = name if name != None else f"{kind} {mxid}"
+        # Only for space jobs
+        self.initial = initial
+        self.ongoing = ongoing
+        self.options = options
+
+class JobResult:
+    def __init__(self, job, metrics):
+        self.job = job
+        self.metrics = metrics
+        self.error = None
+        self.duration = 0
+
+async def run_job(job, session, semaphore, account_concurrency):
+    result = JobResult(job, RunMetrics(job.name))
+    async with semaphore:
+        start = time.monotonic()
+        options = dict(job.options)
+        try:
+            if job.kind == "rename":
+                options.setdefault("planning_concurrency", account_concurrency)
+                options.setdefault("write_concurrency", account_concurrency)
+                await exec_rename(job.strategy, job.homeserver, job.mxid, passwd = job.passwd, token = job.token,
+                        metrics = result.metrics, client_session = session, confirm = False, **options)
+            else:
+                options.setdefault("space_fetch_concurrency", account_concurrency)
+                options.setdefault("write_concurrency", account_concurrency)
+                controller = RoomSpaceController(job.strategy, job.homeserver, job.mxid, passwd = job.passwd, token = job.token,
+                        metrics = result.metrics, client_session = session, **options)
+                await controller.exec_space_manage(initial = job.initial, ongoing = job.ongoing, confirm = False)
+        except Exception as e:
+            # Do not take the other accounts down with this one
+            result.error = e
+            print(f"{job.name} failed:")
+            traceback.print_exc()
+        result.duration = time.monotonic() - start
+    return result
+
+def print_job_summary(results):
+    print("-"*42)
+    print("Summary:")
+    for result in results:
+        status = "OK" if result.error == None else f"FAILED ({result.error})"
+        values = result.metrics.values
+        requests = sum(stats["count"] for stats in result.metrics.requests.values())
+        if result.job.kind == "rename":
+            changes = f"{values.get('planned_renames', 0)} renames"
+        else:
+            changes = f"{values.get('planned_additions', 0)} additions, {values.get('planned_removals', 0)} removals"
+        writes = f"{values.get('writes_succeeded', 0)} written, {values.get('writes_failed', 0)} failed"
+        print(f"{result.job.name}: {status}, {result.duration:.1f}s, {requests} requests, {changes}, {writes}")
+    failed = sum(1 for result in results if result.error != None)
+    print(f"{len(results) - failed}/{len(results)} accounts succeeded")
+    print("-"*42)
+
+async def exec_jobs(jobs, max_parallel_accounts = 4, account_concurrency = 4, max_connections = 64):
+    # Runs all jobs in this event loop without asking for confirmation, sharing one connection pool.
+    # max_parallel_accounts: accounts processed at the same time, ongoing space jobs keep their slot
+    # account_concurrency: default for each account's planning, space fetch and write concurrency
+    # max_connections: HTTP connections over all accounts
+    semaphore = asyncio.Semaphore(max(1, max_parallel_accounts))
+    connector = aiohttp.TCPConnector(limit = max_connections)
+    async with aiohttp.ClientSession(connector = connector) as session:
+        results = await asyncio.gather(*[run_job(job, session, semaphore, account_concurrency) for job in jobs])
+    print_job_summary(results)
+    return results
+
+def run_jobs(jobs, max_parallel_accounts = 4, account_concurrency = 4, max_connections = 64):
+    return asyncio.get_event_loop().run_until_complete(exec_jobs(jobs, max_parallel_accounts, account_concurrency, max_connections))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+#
+# Change plans as JSON lines, one state event to send per line, so planning and applying can be separate runs.
+# Applying keeps a checkpoint next to the plan, an interrupted apply continues where it stopped:
+#   python -m <package>.plan https://example.com:8448 @sepp:example.com plan.jsonl
+# The access token is read from the MATRIX_ACCESS_TOKEN environment variable, else the password is asked for.
+#
+
+import argparse
+import asyncio
+import getpass
+import json
+import os
+import time
+
+from .util import add_lib_path
+from .writer import WriteScheduler
+
+
+# Streams changes to a plan file while they are planned
+class PlanWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w")
+        self.count = 0
+        # A checkpoint of an earlier plan with the same name does not apply to this one
+        if os.path.exists(path + ".checkpoint"):
+            os.remove(path + ".checkpoint")
+
+    def add_state_change(self, kind, room_id, event_type, state_key, content, label):
+        change = {
+            "kind": kind,
+            "room_id": room_id,
+            "type": event_type,
+            "state_key": state_key,
+            "content": content,
+            "label": label,
+        }
+        self.file.write(json.dumps(change, separators=(",", ":")) + "\n")
+        # Keep what is planned so far if the process dies
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        print(f"Wrote {self.count} planned changes to {self.path}")
+
+def read_plan(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                yield json.loads(line)
+
+# Remembers how many changes from the start of the plan are done.
+# Writes finish out of order, so only the completed prefix is stored;
+# changes after it may be sent again on resume, which is fine for state events.
+class PlanCheckpoint:
+    def __init__(self, path, interval = 1.0):
+        self.path = path
+        self.interval = interval
+        self.done = 0
+        self.completed = set()
+        self.last_save = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)["done"]
+
+    def complete(self, index):
+        self.completed.add(index)
+        while self.done in self.completed:
+            self.completed.remove(self.done)
+            self.done += 1
+        if time.monotonic() - self.last_save > self.interval:
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"done": self.done}, f)
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+
+async def exec_apply_plan(homeserver, mxid, plan_path, passwd = None, script_device_id = "PLAN-SCRIPT", device_name = "", token = None, checkpoint_path = None, write_concurrency = 4, write_rate = 5.0, max_pending = 1000):
+    if checkpoint_path == None:
+        checkpoint_path = plan_path + ".checkpoint"
+    checkpoint = PlanCheckpoint(checkpoint_path)
+    if checkpoint.done > 0:
+        print(f"Resuming after {checkpoint.done} applied changes")
+    # Imported here, so the renamer can write plans without depending on mnio
+    add_lib_path("lib/matrix-nio")
+    from mnio import AsyncClient
+    client = AsyncClient(homeserver, mxid, script_device_id)
+    try:
+        if token == None:
+            await client.login(password = passwd, device_name = device_name, token = token)
+        else:
+            client.access_token = token
+            client.user_id = mxid
+            client.device_id = script_device_id
+        writer = WriteScheduler(client, concurrency = write_concurrency, rate = write_rate)
+        for index, change in enumerate(read_plan(plan_path)):
+            if index < checkpoint.done:
+                continue
+            # Do not read the whole plan into pending writes at once
+            while len(writer.tasks) >= max_pending:
+                await asyncio.wait(list(writer.tasks), return_when=asyncio.FIRST_COMPLETED)
+            print(f"{change['label']}")
+            task = writer.put_state(room_id = change["room_id"], event_type = change["type"], content = change["content"], state_key = change["state_key"], label = change["label"])
+            task.add_done_callback(lambda t, index = index: checkpoint.complete(index) if writer.task_succeeded(t) else None)
+        await writer.join()
+        checkpoint.save()
+        writer.print_summary()
+        if writer.failed == 0:
+            print("Plan applied completely")
+        else:
+            print(f"Run again to retry the failed changes, the checkpoint is at {checkpoint.done}")
+    finally:
+        checkpoint.save()
+        if token == None:
+            try:
+                await client.logout()
+            except:
+                pass
+        try:
+            await client.close()
+        except:
+            pass
+
+def apply_plan(homeserver, mxid, plan_path, passwd = None, script_device_id = "PLAN-SCRIPT", device_name = "", token = None, checkpoint_path = None, write_concurrency = 4, write_rate = 5.0):
+    asyncio.get_event_loop().run_until_complete(exec_apply_plan(homeserver, mxid, plan_path, passwd, script_device_id, device_name, token, checkpoint_path, write_concurrency, write_rate))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Apply a plan written by the renamer or space management")
+    parser.add_argument("homeserver")
+    parser.add_argument("mxid")
+    parser.add_argument("plan")
+    parser.add_argument("--checkpoint", help = "Default: <plan>.checkpoint")
+    parser.add_argument("--write-concurrency", type = int, default = 4)
+    parser.add_argument("--write-rate", type = float, default = 5.0)
+    args = parser.parse_args()
+    token = os.environ.get("MATRIX_ACCESS_TOKEN")
+    passwd = getpass.getpass("Password: ") if token == None else None
+    apply_plan(args.homeserver, args.mxid, args.plan, passwd = passwd, token = token, checkpoint_path = args.checkpoint,
+            write_concurrency = args.write_concurrency, write_rate = args.write_rate)
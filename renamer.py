@@ -2,9 +2,18 @@
 
 import asyncio
 import getpass
+import time
 from colorama import Fore, Style
 
-from .util import add_lib_path
+from .util import add_lib_path, bounded_map, get_sync_filter, bridge_cache
+from .store import SyncStore
+from .members import MemberSource
+from .writer import WriteScheduler
+from .decisioncache import DecisionCache, decision_fingerprint
+from .metrics import RunMetrics
+from .targeted import get_joined_room_ids, load_room, iter_rooms
+from .plan import PlanWriter
+from .batch import RoomSnapshot, chunks, make_process_pool, run_in_pool
 
 add_lib_path("lib/matrix-nio")
 from nio import AsyncClient, MatrixRoom, RoomGetStateEventError
@@ -21,13 +30,35 @@ class PlannedRename:
         self.old_avatar = old_avatar
         self.new_avatar = new_avatar
 
+def rename_content(pr):
+    # Compare https://github.com/matrix-org/matrix-react-sdk/blob/7c4a84aae0b764842fadd38237c1a857437c4f51/src/SlashCommands.tsx#L274
+    # https://github.com/matrix-org/matrix-doc/blob/8eb1c531442093d239ab35027d784c4d9cfc8ac9/specification/client_server_api.rst#L1975
+    # https://github.com/matrix-org/matrix-doc/blob/9281d0ca13c39b83b8bbba184c8887d3d4faf045/event-schemas/schema/m.room.member
+    # https://github.com/matrix-org/matrix-doc/blob/370ae8b9fe873b3ce061e4a8dbd7cf836388d640/event-schemas/examples/m.room.member
+    # https://github.com/poljar/matrix-nio/blob/41636f04c14ffede01cf31abc309615b16ac949b/nio/client/async_client.py#L1570
+    return {
+        "membership": "join",
+        "displayname": pr.new_name,
+        "avatar_url": pr.new_avatar
+    }
+
 class Strategy:
+    # Set to a list of inputs from decisioncache.DECISION_INPUTS that get_new_name_and_avatar depends on,
+    # to reuse its decisions for rooms with the same inputs
+    decision_inputs = None
+    # Set to plan rooms in chunks of this size with get_new_names_and_avatars
+    batch_size = None
     def nick_change_allowed(self, myroomnick, myavatarurl):
         return True
     def avatar_change_allowed(self, myroomnick, myavatarurl):
         return True
     async def get_new_name_and_avatar(self, client, myroomnick, myavatarurl, room, members):
         return myroomnick, myavatarurl
+    async def get_new_names_and_avatars(self, client, snapshots):
+        # One (name, avatar) per batch.RoomSnapshot. Override to decide for all rooms of a chunk together,
+        # by default each room is decided on its own.
+        # With a process pool, a synchronous classify_batch(snapshots) with the same result is called instead.
+        return [await self.get_new_name_and_avatar(client, snapshot.nick, snapshot.avatar, snapshot.room, snapshot.members) for snapshot in snapshots]
 
 class KeepUnknownStrategy(Strategy):
     def __init__(self, known_display_names, known_avatars):
@@ -38,8 +69,151 @@ class KeepUnknownStrategy(Strategy):
     def avatar_change_allowed(self, myroomnick, myavatarurl):
         return myavatarurl in self.known_avatars
 
-async def exec_rename(strategy, homeserver, mxid, passwd = None, script_device_id = "RN-SCRIPT", device_name = "", token = None):
-    client = AsyncClient(homeserver, mxid, script_device_id)
+class PrintedReport(list):
+    # Report lines that are printed as they are added, when rooms are planned one after another.
+    # Output of the strategy itself then appears below the header of its room.
+    def append(self, line):
+        print(line)
+        super().append(line)
+
+def start_room_rename(strategy, mxid, room, report = None):
+    # Returns the report lines so far, and whether the strategy may change anything in this room
+    if report == None:
+        report = []
+    if mxid not in room.users:
+        # Our member event could not be loaded, so there is nothing to rename from
+        report.append("ROOM {} {} (own member unknown)".format(room.display_name, room.room_id))
+        report.append("  => skip")
+        return report, False
+    myroomnick = room.user_name(mxid)
+    myavatarurl = room.avatar_url(mxid)
+    nick_change_allowed = strategy.nick_change_allowed(myroomnick, myavatarurl)
+    avatar_change_allowed = strategy.avatar_change_allowed(myroomnick, myavatarurl)
+    report.append("ROOM {} {} {}".format(room.display_name, room.room_id, myroomnick if nick_change_allowed else f"{Fore.MAGENTA}{myroomnick}{Style.RESET_ALL}"))
+    if not nick_change_allowed and not avatar_change_allowed:
+        report.append("  => skip")
+        return report, False
+    return report, True
+
+def finish_room_rename(strategy, mxid, room, report, new_name, new_avatar):
+    myroomnick = room.user_name(mxid)
+    myavatarurl = room.avatar_url(mxid)
+    if not strategy.nick_change_allowed(myroomnick, myavatarurl):
+        new_name = myroomnick
+    if not strategy.avatar_change_allowed(myroomnick, myavatarurl):
+        new_avatar = myavatarurl
+    if myroomnick == new_name and myavatarurl == new_avatar:
+        report.append("  => keep {}".format(myroomnick))
+        return report, None
+    report.append(f"  => {Fore.YELLOW}{myroomnick}|{myavatarurl}{Style.RESET_ALL} -> {Fore.CYAN}{new_name}|{new_avatar}{Style.RESET_ALL}")
+    return report, PlannedRename(room_id=room.room_id, room_name=room.display_name, old_name=myroomnick, new_name=new_name, old_avatar=myavatarurl, new_avatar=new_avatar)
+
+async def plan_room_rename(client, strategy, mxid, room, member_source, decision_cache = None, metrics = None, report = None):
+    # Returns the report lines for this room, and the planned rename if any.
+    # report: list to add the report lines to, e.g. a PrintedReport
+    if metrics == None:
+        metrics = RunMetrics()
+    report, change_allowed = start_room_rename(strategy, mxid, room, report)
+    if not change_allowed:
+        return report, None
+    with metrics.phase("members"):
+        members = await member_source.get_members(client, room)
+    return await decide_room_rename(client, strategy, mxid, room, members, report, decision_cache, metrics)
+
+async def decide_room_rename(client, strategy, mxid, room, members, report, decision_cache = None, metrics = None):
+    # The part of plan_room_rename after start_room_rename allowed a change and the members are known
+    if metrics == None:
+        metrics = RunMetrics()
+    myroomnick = room.user_name(mxid)
+    myavatarurl = room.avatar_url(mxid)
+    with metrics.phase("strategy"):
+        if decision_cache != None and strategy.decision_inputs != None:
+            key = decision_fingerprint(strategy.decision_inputs, room, members, myroomnick, myavatarurl)
+            found, decision = decision_cache.get(key)
+            if not found:
+                decision = await strategy.get_new_name_and_avatar(client, myroomnick, myavatarurl, room, members)
+                decision_cache.put(key, decision)
+            new_name, new_avatar = decision
+        else:
+            new_name, new_avatar = await strategy.get_new_name_and_avatar(client, myroomnick, myavatarurl, room, members)
+    return finish_room_rename(strategy, mxid, room, report, new_name, new_avatar)
+
+async def plan_rooms_rename(client, strategy, mxid, rooms, member_source, decision_cache = None, metrics = None, pool = None, member_concurrency = 8):
+    # Like plan_room_rename for a chunk of rooms, with one strategy call for all undecided rooms.
+    # Returns (report lines, planned rename or None) per room, in room order.
+    if metrics == None:
+        metrics = RunMetrics()
+    reports = [start_room_rename(strategy, mxid, room) for room in rooms]
+    candidates = [room for room, (report, change_allowed) in zip(rooms, reports) if change_allowed]
+    candidate_reports = [report for report, change_allowed in reports if change_allowed]
+    with metrics.phase("members"):
+        members = [result async for result in bounded_map(lambda room: member_source.get_members(client, room), candidates, member_concurrency)]
+    decided = dict(zip([room.room_id for room in candidates], await decide_rooms_rename(client, strategy, mxid, candidates, members, candidate_reports, decision_cache, metrics, pool)))
+    results = []
+    for room, (report, change_allowed) in zip(rooms, reports):
+        results.append(decided[room.room_id] if change_allowed else (report, None))
+    return results
+
+async def decide_rooms_rename(client, strategy, mxid, rooms, members, reports, decision_cache = None, metrics = None, pool = None):
+    # The part of plan_rooms_rename after start_room_rename allowed a change in all rooms and their members are known.
+    # Returns (report lines, planned rename or None) per room, in room order.
+    if metrics == None:
+        metrics = RunMetrics()
+    decisions = dict()
+    keys = dict()
+    snapshots = []
+    for room, room_members in zip(rooms, members):
+        snapshot = RoomSnapshot(room, room_members, room.user_name(mxid), room.avatar_url(mxid))
+        if decision_cache != None and strategy.decision_inputs != None:
+            key = decision_fingerprint(strategy.decision_inputs, room, room_members, snapshot.nick, snapshot.avatar)
+            found, decision = decision_cache.get(key)
+            if found:
+                decisions[room.room_id] = decision
+                continue
+            keys[room.room_id] = key
+        snapshots.append(snapshot)
+    if len(snapshots) > 0:
+        with metrics.phase("strategy"):
+            if pool != None:
+                results = await run_in_pool(pool, strategy, snapshots)
+            else:
+                results = await strategy.get_new_names_and_avatars(client, snapshots)
+        for snapshot, decision in zip(snapshots, results):
+            decision = tuple(decision)
+            decisions[snapshot.room_id] = decision
+            if snapshot.room_id in keys:
+                decision_cache.put(keys[snapshot.room_id], decision)
+    results = []
+    for room, report in zip(rooms, reports):
+        new_name, new_avatar = decisions[room.room_id]
+        results.append(finish_room_rename(strategy, mxid, room, report, new_name, new_avatar))
+    return results
+
+async def exec_rename(strategy, homeserver, mxid, passwd = None, script_device_id = "RN-SCRIPT", device_name = "", token = None, planning_concurrency = 1, store_path = None, use_sync_filter = True, write_concurrency = 4, write_rate = 5.0, decision_cache_size = 4096, member_source = "hybrid", report_path = None, metrics = None, client_session = None, confirm = True, planning_source = "sync", plan_path = None, batch_processes = 0):
+    # Pass own metrics to add hooks, report_path to write a JSON report of the run.
+    # client_session: aiohttp session to share with other clients, it is not closed here.
+    # confirm: ask before renaming
+    # planning_source: "sync" to get rooms from an initial sync, "targeted" to skip the sync and
+    # only request the state needed per room, planning each room as soon as its state arrived
+    # plan_path: stream planned renames to this file instead of renaming, see plan.apply_plan
+    # batch_processes: for strategies with a batch_size, run their classify_batch in a pool of this many processes
+    # With planning_concurrency 1, each room's report is printed while it is planned. Otherwise reports are printed
+    # in room order once planned, so output a strategy prints itself can appear away from its room.
+    if metrics == None:
+        metrics = RunMetrics("rename")
+    client = metrics.instrument_client(AsyncClient(homeserver, mxid, script_device_id))
+    if client_session != None:
+        client.client_session = client_session
+    if planning_source == "targeted":
+        # Targeted rooms only know our own member
+        store = None
+        member_source = MemberSource("remote")
+    else:
+        store = SyncStore(store_path, mxid) if store_path != None else None
+        member_source = MemberSource(member_source, store = store)
+    decision_cache = DecisionCache(decision_cache_size) if decision_cache_size > 0 else None
+    plan_writer = None
+    pool = make_process_pool(batch_processes) if strategy.batch_size != None else None
     try:
         if token == None:
             await client.login(password = passwd, device_name = device_name, token = token)
@@ -48,31 +222,70 @@ async def exec_rename(strategy, homeserver, mxid, passwd = None, script_device_i
             client.user_id = mxid
             client.device_id = script_device_id
         print("Fetching rooms...")
-        # Sync fetches rooms
-        await client.sync(set_presence="offline")
+        if planning_source == "targeted":
+            with metrics.phase("joined_rooms"):
+                rooms = await get_joined_room_ids(client)
+            async def plan_room(room_id, report = None):
+                with metrics.phase("room_state"):
+                    room = await load_room(client, mxid, room_id)
+                return await plan_room_rename(client, strategy, mxid, room, member_source, decision_cache, metrics, report)
+        else:
+            # Sync fetches rooms
+            with metrics.phase("sync"):
+                sync_filter = await get_sync_filter(client, store = store) if use_sync_filter else None
+                if store != None:
+                    sync_response = await store.sync(client, set_presence="offline", sync_filter=sync_filter)
+                else:
+                    sync_response = await client.sync(set_presence="offline", sync_filter=sync_filter)
+            # Strategies asking for bridges of a room do not need to fetch its state again
+            bridge_cache.update_from_sync(sync_response, complete = store == None or store.changed_rooms == None)
+            rooms = list(client.rooms.values())
+            plan_room = lambda room, report = None: plan_room_rename(client, strategy, mxid, room, member_source, decision_cache, metrics, report)
+        async def plan_rooms():
+            if strategy.batch_size == None and planning_concurrency <= 1:
+                for room in rooms:
+                    yield await plan_room(room, PrintedReport())
+                return
+            if strategy.batch_size == None:
+                async for result in bounded_map(plan_room, rooms, planning_concurrency):
+                    yield result
+                return
+            for chunk in chunks(rooms, strategy.batch_size):
+                if planning_source == "targeted":
+                    with metrics.phase("room_state"):
+                        chunk = [room async for room in iter_rooms(client, mxid, chunk, planning_concurrency)]
+                for result in await plan_rooms_rename(client, strategy, mxid, chunk, member_source, decision_cache, metrics, pool, planning_concurrency):
+                    yield result
         planned_renames = []
-        for room in client.rooms.values():
-            room_id = room.room_id
-            myroomnick = room.user_name(mxid)
-            myavatarurl = room.avatar_url(mxid)
-            nick_change_allowed = strategy.nick_change_allowed(myroomnick, myavatarurl)
-            avatar_change_allowed = strategy.avatar_change_allowed(myroomnick, myavatarurl)
-            print("ROOM {} {} {}".format(room.display_name, room_id, myroomnick if nick_change_allowed else (Fore.MAGENTA + myroomnick + Style.RESET_ALL)))
-            if not nick_change_allowed and not avatar_change_allowed:
-                print("  => skip")
-                continue
-            member_response = await client.joined_members(room_id = room_id)
-            members = member_response.members
-            new_name, new_avatar = await strategy.get_new_name_and_avatar(client, myroomnick, myavatarurl, room, members)
-            if not nick_change_allowed:
-                new_name = myroomnick
-            if not avatar_change_allowed:
-                new_avatar = myavatarurl
-            if myroomnick == new_name and myavatarurl == new_avatar:
-                print("  => keep {}".format(myroomnick))
-            else:
-                print(f"  => {Fore.YELLOW}{myroomnick}|{myavatarurl}{Style.RESET_ALL} -> {Fore.CYAN}{new_name}|{new_avatar}{Style.RESET_ALL}")
-                planned_renames.append(PlannedRename(room_id=room_id, room_name=room.display_name, old_name=myroomnick, new_name=new_name, old_avatar=myavatarurl, new_avatar=new_avatar))
+        planned_count = 0
+        if plan_path != None:
+            plan_writer = PlanWriter(plan_path)
+        # Up to planning_concurrency rooms are planned at once, reports are still printed in room order
+        planning_start = time.monotonic()
+        with metrics.phase("planning"):
+            async for report, planned_rename in plan_rooms():
+                if not isinstance(report, PrintedReport):
+                    for line in report:
+                        print(line)
+                if planned_rename != None:
+                    if planned_count == 0:
+                        metrics.set_value("time_to_first_planned_change", time.monotonic() - planning_start)
+                    planned_count += 1
+                    if plan_writer != None:
+                        plan_writer.add_state_change("rename", planned_rename.room_id, "m.room.member", mxid, rename_content(planned_rename), planned_rename.room_name)
+                    else:
+                        planned_renames.append(planned_rename)
+        metrics.set_value("rooms", len(rooms))
+        metrics.set_value("planned_renames", planned_count)
+        metrics.record_planning(member_source, decision_cache)
+        member_source.print_summary()
+        if decision_cache != None and strategy.decision_inputs != None:
+            decision_cache.print_summary()
+        if plan_writer != None:
+            plan_writer.close()
+            if store != None:
+                store.commit()
+            return planned_renames
         # get max room name length only for planned renames for formatting
         max_room_name_len = 0
         for pr in planned_renames:
@@ -84,33 +297,44 @@ async def exec_rename(strategy, homeserver, mxid, passwd = None, script_device_i
             room_name = room_format.format(pr.room_name)
             print(f"{room_name} |{pr.old_name}|{pr.old_avatar} -> {pr.new_name}|{pr.new_avatar}")
         print("-"*42)
-        input("Enter to rename")
+        if confirm:
+            input("Enter to rename")
+        writer = WriteScheduler(client, concurrency = write_concurrency, rate = write_rate)
         for pr in planned_renames:
             room_id = pr.room_id
-            # Compare https://github.com/matrix-org/matrix-react-sdk/blob/7c4a84aae0b764842fadd38237c1a857437c4f51/src/SlashCommands.tsx#L274
-            # https://github.com/matrix-org/matrix-doc/blob/8eb1c531442093d239ab35027d784c4d9cfc8ac9/specification/client_server_api.rst#L1975
-            # https://github.com/matrix-org/matrix-doc/blob/9281d0ca13c39b83b8bbba184c8887d3d4faf045/event-schemas/schema/m.room.member
-            # https://github.com/matrix-org/matrix-doc/blob/370ae8b9fe873b3ce061e4a8dbd7cf836388d640/event-schemas/examples/m.room.member
-            # https://github.com/poljar/matrix-nio/blob/41636f04c14ffede01cf31abc309615b16ac949b/nio/client/async_client.py#L1570
-            content = {
-                "membership": "join",
-                "displayname": pr.new_name,
-                "avatar_url": pr.new_avatar
-            }
+            content = rename_content(pr)
             print(f"{pr.room_name}: {content}")
-            result = await client.room_put_state(room_id = room_id, event_type = "m.room.member", content = content, state_key = mxid)
-            if VERBOSE:
-                print(result)
+            writer.put_state(room_id = room_id, event_type = "m.room.member", content = content, state_key = mxid, label = pr.room_name)
+        with metrics.phase("writes"):
+            await writer.join()
+        writer.print_summary()
+        metrics.record_writer(writer)
+        if store != None:
+            store.commit()
+        return planned_renames
     finally:
+        if pool != None:
+            pool.shutdown()
+        if plan_writer != None:
+            plan_writer.close()
+        if report_path != None:
+            metrics.write_report(report_path)
+        if store != None:
+            store.close()
         if token == None:
             try:
                 await client.logout()
             except:
                 pass
+            if client_session != None:
+                # Owned by the caller
+                client.client_session = None
             try:
                 await client.close()
             except:
                 pass
 
-def rename(strategy, homeserver, mxid, passwd = None, script_device_id = "RN-SCRIPT", device_name = "", token = None):
-    asyncio.get_event_loop().run_until_complete(exec_rename(strategy, homeserver, mxid, passwd, script_device_id, device_name, token))
+def rename(strategy, homeserver, mxid, passwd = None, script_device_id = "RN-SCRIPT", device_name = "", token = None, planning_concurrency = 1, store_path = None, use_sync_filter = True, write_concurrency = 4, write_rate = 5.0, decision_cache_size = 4096, member_source = "hybrid", report_path = None, metrics = None, confirm = True, planning_source = "sync", plan_path = None, batch_processes = 0):
+    return asyncio.get_event_loop().run_until_complete(exec_rename(strategy, homeserver, mxid, passwd = passwd, script_device_id = script_device_id, device_name = device_name, token = token,
+            planning_concurrency = planning_concurrency, store_path = store_path, use_sync_filter = use_sync_filter, write_concurrency = write_concurrency, write_rate = write_rate,
+            decision_cache_size = decision_cache_size, member_source = member_source, report_path = report_path, metrics = metrics, confirm = confirm, planning_source = planning_source, plan_path = plan_path, batch_processes = batch_processes))
@@ -4,23 +4,41 @@ import asyncio
 import getpass
 from colorama import Fore, Style
 import sys
+import time
 
-from .util import add_lib_path
+from .util import add_lib_path, bounded_map, get_sync_filter, bridge_cache
+from .store import SyncStore
+from .members import MemberSource
+from .spaceindex import RoomSpaceIndex, apply_space_child_events
+from .writer import WriteScheduler
+from .decisioncache import DecisionCache, decision_fingerprint
+from .metrics import RunMetrics
+from .targeted import iter_rooms
+from .plan import PlanWriter
+from .hierarchy import SpaceHierarchy, load_hierarchies
+from .batch import RoomSnapshot, chunks, make_process_pool, run_in_pool
+from .workqueue import RoomWorkQueue, LIVE, BACKLOG
+from .via import ViaServers
 
 add_lib_path("lib/matrix-nio")
 from mnio import AsyncClient, MatrixRoom, RoomGetStateEventError
 from mnio.event_builders import AddSpaceChildBuilder, RemoveSpaceChildBuilder
 from mnio.responses import RoomGetStateEventResponse
-from mnio import RoomMemberEvent, SpaceChildEvent
+from mnio import RoomMemberEvent, SpaceChildEvent, PowerLevelsEvent, SyncResponse
 
 
 
 VERBOSE = sys.stdout.isatty()
 
+def is_space(room):
+    return room.room_type == "m.space" or room.room_type == "org.matrix.msc1772.space"
+
 class PlannedSpaceAdd:
-    def __init__(self, space, room):
+    def __init__(self, space, room, members = None):
         self.space = space
         self.room = room
+        # Members the room was planned with, for the via servers
+        self.members = members
 
 class PlannedSpaceRemove:
     def __init__(self, space, room):
@@ -28,13 +46,43 @@ class PlannedSpaceRemove:
         self.room = room
 
 class SpaceStrategy:
-    async def get_new_spaces(self, client, myroomnick, myavatarurl, room, members, previous_spaces):
+    # Set to a list of inputs from decisioncache.DECISION_INPUTS that get_new_spaces depends on,
+    # to reuse its decisions for rooms with the same inputs
+    decision_inputs = None
+    # Set to plan rooms in chunks of this size with get_new_spaces_batch
+    batch_size = None
+    # When the controller loads the space hierarchy, get_new_spaces is also passed its hierarchy.SpaceHierarchy,
+    # e.g. to look up sub-spaces with hierarchy.get_ancestors(room_id). Batch snapshots have it as snapshot.hierarchy.
+    async def get_new_spaces(self, client, myroomnick, myavatarurl, room, members, previous_spaces, hierarchy = None):
         return []
+    async def get_new_spaces_batch(self, client, snapshots):
+        # One list of spaces per batch.RoomSnapshot. Override to decide for all rooms of a chunk together,
+        # by default each room is decided on its own.
+        # With a process pool, a synchronous classify_batch(snapshots) returning space ids is called instead.
+        return [await self.get_new_spaces(client, snapshot.nick, snapshot.avatar, snapshot.room, snapshot.members, snapshot.spaces, **hierarchy_argument(snapshot.hierarchy)) for snapshot in snapshots]
     def get_via_for_room(self, room):
-        raise NotImplementedError()
+        # None to use the controller's via.ViaServers ranking
+        return None
+
+def hierarchy_argument(hierarchy):
+    # Only passed when loaded, strategies that do not use it need not take the argument
+    return {"hierarchy": hierarchy} if hierarchy != None else {}
+
+def space_child_add_event(room_id, via_servers):
+    return AddSpaceChildBuilder(
+            room_id = room_id,
+            via_servers = via_servers,
+            auto_join = False,
+            suggested = False
+    ).as_dict()
+
+def space_child_remove_event(room_id):
+    return RemoveSpaceChildBuilder(
+            room_id = room_id,
+    ).as_dict()
 
 class RoomSpaceController:
-    def __init__(self, strategy, homeserver, mxid, passwd = None, script_device_id = "RS-SCRIPT", device_name = "", token = None):
+    def __init__(self, strategy, homeserver, mxid, passwd = None, script_device_id = "RS-SCRIPT", device_name = "", token = None, space_fetch_concurrency = 8, store_path = None, use_sync_filter = True, debounce_seconds = 2.0, write_concurrency = 4, write_rate = 5.0, decision_cache_size = 4096, space_children_source = "sync", member_source = "hybrid", report_path = None, metrics = None, client_session = None, planning_source = "sync", load_space_hierarchy = False, batch_processes = 0, room_workers = 4, full_resync_interval = None):
         self.strategy = strategy
         self.homeserver = homeserver
         self.mxid = mxid
@@ -42,22 +90,143 @@ class RoomSpaceController:
         self.script_device_id = script_device_id
         self.device_name = device_name
         self.token = token
+        self.space_fetch_concurrency = space_fetch_concurrency
+        self.store_path = store_path
+        self.use_sync_filter = use_sync_filter
+        self.debounce_seconds = debounce_seconds
+        self.write_concurrency = write_concurrency
+        self.write_rate = write_rate
+        self.writer = None
+        # "sync": read space children from the initial sync where possible, "http": fetch the state of every space
+        self.space_children_source = space_children_source
+        self.sync_response = None
+        self.sync_complete = False
+        self.decision_cache = DecisionCache(decision_cache_size) if decision_cache_size > 0 else None
+        # room id -> number of events received for it in the current debounce window
+        self.dirty_rooms = dict()
+        self.room_update_tasks = set()
+        self.coalesced_event_count = 0
+        # Events that were echoes of our own writes and did not trigger a room update
+        self.suppressed_echo_count = 0
+        self.store = None
+        self.member_source_mode = member_source
+        self.member_source = None
         self.client = None
-        self.room_space_cache = dict()
-        self.spaces_cache = []
+        self.space_index = RoomSpaceIndex()
+        # While a new index is built, (method name, arguments) of the changes to the current one, see change_space_index
+        self.space_index_changes = None
+        # Pass own metrics to add hooks, report_path to write a JSON report of the run
+        self.report_path = report_path
+        self.metrics = metrics if metrics != None else RunMetrics("space_manage")
+        # aiohttp session to share with other clients, it is not closed here
+        self.client_session = client_session
+        # "sync", or "targeted" to skip the sync for a one-shot run and only request the state needed per room
+        self.planning_source = planning_source
+        # Also load nested spaces we have not joined with /hierarchy, which is passed to the strategy
+        self.load_space_hierarchy = load_space_hierarchy
+        self.hierarchy = SpaceHierarchy()
+        # For strategies with a batch_size, run their classify_batch in a pool of this many processes
+        self.batch_processes = batch_processes
+        self.pool = None
+        # In ongoing mode, rooms to update are queued for this many workers, live updates before the initial pass
+        self.room_workers = room_workers
+        self.queue = None
+        self.backlog_task = None
+        # Ranked via servers per room, kept up to date from member and power level events
+        self.via_servers = ViaServers()
+        # Ongoing syncs only get the changes since the previous sync. Seconds between syncs of the full state
+        # of all rooms, in case something was missed anyway; None to only do that when full_resync is called.
+        self.full_resync_interval = full_resync_interval
+        self.live_sync_filter = None
+        self.resync_task = None
+        # Set by full_resync, for the next sync of sync_forever
+        self.full_resync_requested = False
+        self.full_resync_count = 0
+        self.state_gap_count = 0
 
     async def handle_room(self, room):
-        planned_additions = []
-        planned_removals = []
-        if room.room_type == "m.space" or room.room_type == "org.matrix.msc1772.space":
+        snapshot = await self.snapshot_room(room)
+        if snapshot == None:
             # Do not automatically add spaces to spaces
             return [], []
-        room_id = room.room_id
+        return await self.decide_spaces(snapshot)
+
+    async def decide_spaces(self, snapshot):
+        if self.strategy.batch_size != None:
+            # Batch strategies may only implement get_new_spaces_batch or classify_batch, so single
+            # rooms (live updates, the queued backlog) are decided as a chunk of one
+            decisions = await self.decide_batch([snapshot])
+            return await self.plan_space_changes(snapshot, decisions[snapshot.room_id])
+        room = snapshot.room
+        spaces_for_room = snapshot.spaces
+        old_spaces_for_room = spaces_for_room.copy()
+        with self.metrics.phase("strategy"):
+            if self.decision_cache != None and self.strategy.decision_inputs != None:
+                key = decision_fingerprint(self.strategy.decision_inputs, room, snapshot.members, snapshot.nick, snapshot.avatar, spaces_for_room)
+                found, new_spaces_for_room = self.decision_cache.get(key)
+                if not found:
+                    new_spaces_for_room = await self.strategy.get_new_spaces(self.client, snapshot.nick, snapshot.avatar, room, snapshot.members, old_spaces_for_room, **hierarchy_argument(snapshot.hierarchy))
+                    new_spaces_for_room = [space if isinstance(space, str) else space.room_id for space in new_spaces_for_room]
+                    self.decision_cache.put(key, new_spaces_for_room)
+            else:
+                new_spaces_for_room = await self.strategy.get_new_spaces(self.client, snapshot.nick, snapshot.avatar, room, snapshot.members, old_spaces_for_room, **hierarchy_argument(snapshot.hierarchy))
+        return await self.plan_space_changes(snapshot, new_spaces_for_room)
+
+    async def handle_rooms(self, rooms):
+        # Like handle_room for a chunk of rooms, with one strategy call for all undecided rooms
+        snapshots = [snapshot async for snapshot in bounded_map(self.snapshot_room, rooms, self.space_fetch_concurrency) if snapshot != None]
+        decisions = await self.decide_batch(snapshots)
+        planned_additions = []
+        planned_removals = []
+        for snapshot in snapshots:
+            pa, pr = await self.plan_space_changes(snapshot, decisions[snapshot.room_id])
+            planned_additions += pa
+            planned_removals += pr
+        return planned_additions, planned_removals
+
+    async def decide_batch(self, snapshots):
+        # room id -> new space ids, from the decision cache or the strategy's batch method
+        decisions = dict()
+        keys = dict()
+        undecided = []
+        for snapshot in snapshots:
+            if self.decision_cache != None and self.strategy.decision_inputs != None:
+                key = decision_fingerprint(self.strategy.decision_inputs, snapshot.room, snapshot.members, snapshot.nick, snapshot.avatar, snapshot.space_ids)
+                found, decision = self.decision_cache.get(key)
+                if found:
+                    decisions[snapshot.room_id] = decision
+                    continue
+                keys[snapshot.room_id] = key
+            undecided.append(snapshot)
+        if len(undecided) > 0:
+            with self.metrics.phase("strategy"):
+                if self.pool != None:
+                    results = await run_in_pool(self.pool, self.strategy, undecided)
+                else:
+                    results = await self.strategy.get_new_spaces_batch(self.client, undecided)
+            for snapshot, new_spaces in zip(undecided, results):
+                new_spaces = [space if isinstance(space, str) else space.room_id for space in new_spaces]
+                decisions[snapshot.room_id] = new_spaces
+                if snapshot.room_id in keys:
+                    self.decision_cache.put(keys[snapshot.room_id], new_spaces)
+        return decisions
+
+    def get_via_for_room(self, room, members = None):
+        # The strategy's via servers, or the ranking of this controller. Strategies may be shared by
+        # several controllers (e.g. in multi), so the ranking is not stored on the strategy.
+        via_servers = self.strategy.get_via_for_room(room)
+        if via_servers == None:
+            via_servers = self.via_servers.get_via_for_room(room, members)
+        return via_servers
+
+    async def snapshot_room(self, room, members = None):
+        # None for spaces
+        if is_space(room):
+            return None
         room_name = room.display_name
-        myroomnick = room.user_name(self.mxid)
-        myavatarurl = room.avatar_url(self.mxid)
-        member_response = await self.client.joined_members(room_id = room_id)
-        members = member_response.members
+        if members == None:
+            with self.metrics.phase("members"):
+                members = await self.member_source.get_members(self.client, room)
         spaces_for_room = await self.get_space_list_for_room(room)
         if VERBOSE:
             if len(spaces_for_room) > 0:
@@ -66,17 +235,24 @@ class RoomSpaceController:
                     print(f"- {space.display_name}")
             else:
                 print(f"{room_name} is in no spaces.")
-        old_spaces_for_room = spaces_for_room.copy()
-        new_spaces_for_room = await self.strategy.get_new_spaces(self.client, myroomnick, myavatarurl, room, members, old_spaces_for_room)
+        hierarchy = self.hierarchy if self.load_space_hierarchy else None
+        return RoomSnapshot(room, members, room.user_name(self.mxid), room.avatar_url(self.mxid), spaces_for_room, hierarchy)
+
+    async def plan_space_changes(self, snapshot, new_spaces_for_room):
+        planned_additions = []
+        planned_removals = []
+        room = snapshot.room
         # For comparison what changed, use room ids
-        old_spaces_for_room = [space.room_id for space in spaces_for_room]
-        new_spaces_for_room = [space if isinstance(space, str) else space.room_id for space in new_spaces_for_room]
+        old_spaces_for_room = list(snapshot.space_ids)
+        new_spaces_for_room = list(dict.fromkeys(space if isinstance(space, str) else space.room_id for space in new_spaces_for_room))
+        old_space_ids = set(old_spaces_for_room)
+        new_space_ids = set(new_spaces_for_room)
         for candidate in new_spaces_for_room:
-            if candidate not in old_spaces_for_room:
+            if candidate not in old_space_ids:
                 candidate = await self.get_space_from_id(candidate)
-                planned_additions.append(PlannedSpaceAdd(candidate, room))
+                planned_additions.append(PlannedSpaceAdd(candidate, room, snapshot.members))
         for candidate in old_spaces_for_room:
-            if candidate not in new_spaces_for_room:
+            if candidate not in new_space_ids:
                 candidate = await self.get_space_from_id(candidate)
                 planned_removals.append(PlannedSpaceRemove(candidate, room))
         return planned_additions, planned_removals
@@ -90,14 +266,56 @@ class RoomSpaceController:
             print(f"{pr.room.display_name} x {pr.space.display_name}")
 
     async def exec_planned_changes(self, planned_additions, planned_removals):
+            if len(planned_additions) == 0 and len(planned_removals) == 0:
+                return
+            tasks = []
             for pa in planned_additions:
-                await self.add_room_to_space(pa.space, pa.room, self.strategy.get_via_for_room(pa.room))
+                tasks.append(await self.add_room_to_space(pa.space, pa.room, self.get_via_for_room(pa.room, pa.members)))
             for pa in planned_removals:
-                await self.remove_room_from_space(pa.space, pa.room)
+                tasks.append(await self.remove_room_from_space(pa.space, pa.room))
+            # Only wait for these writes, other rooms may be updated at the same time
+            with self.metrics.phase("writes"):
+                await asyncio.gather(*tasks, return_exceptions=True)
+            self.report_writes(tasks)
+
+    def report_writes(self, tasks):
+        # After each update only its failures are counted, the writer's summary is printed once at the end
+        failed = sum(1 for task in tasks if not self.writer.task_succeeded(task))
+        if failed > 0:
+            print(f"{failed} of {len(tasks)} writes failed")
+        self.metrics.record_writer(self.writer)
 
-    async def exec_space_manage(self, initial = True, ongoing = False):
+    def write_planned_changes(self, plan_writer, planned_additions, planned_removals):
+        for pa in planned_additions:
+            event_dict = space_child_add_event(pa.room.room_id, self.get_via_for_room(pa.room, pa.members))
+            plan_writer.add_state_change("space_add", pa.space.room_id, event_dict["type"], event_dict["state_key"], event_dict["content"],
+                    f"{pa.room.display_name} -> {pa.space.display_name}")
+        for pr in planned_removals:
+            event_dict = space_child_remove_event(pr.room.room_id)
+            plan_writer.add_state_change("space_remove", pr.space.room_id, event_dict["type"], event_dict["state_key"], event_dict["content"],
+                    f"{pr.room.display_name} x {pr.space.display_name}")
+
+    async def exec_space_manage(self, initial = True, ongoing = False, confirm = True, plan_path = None):
+        # confirm: ask before executing the initial changes, unless ongoing
+        # plan_path: stream the initial changes to this file instead of executing them, see plan.apply_plan
+        if ongoing and self.planning_source == "targeted":
+            raise ValueError("Targeted planning only works for one-shot runs")
+        if ongoing and plan_path != None:
+            raise ValueError("Plans can only be written for one-shot runs")
+        plan_writer = None
         try:
-            self.client = AsyncClient(self.homeserver, self.mxid, self.script_device_id)
+            self.client = self.metrics.instrument_client(AsyncClient(self.homeserver, self.mxid, self.script_device_id))
+            if self.client_session != None:
+                self.client.client_session = self.client_session
+            # When listening, the syncs bring our own writes back, which do not need another evaluation
+            self.writer = WriteScheduler(self.client, concurrency = self.write_concurrency, rate = self.write_rate, track_echoes = ongoing)
+            if self.planning_source == "targeted":
+                # Targeted rooms only know our own member
+                self.member_source = MemberSource("remote")
+            else:
+                if self.store_path != None:
+                    self.store = SyncStore(self.store_path, self.mxid)
+                self.member_source = MemberSource(self.member_source_mode, store = self.store)
             if self.token == None:
                 await self.client.login(password = self.passwd, device_name = self.device_name, token = self.token)
             else:
@@ -105,48 +323,169 @@ class RoomSpaceController:
                 self.client.user_id = self.mxid
                 self.client.device_id = self.script_device_id
             print("Fetching rooms...")
-            # Sync fetches rooms
-            await self.client.sync(set_presence="offline")
+            if self.planning_source == "targeted":
+                # Spaces need to be known before any room can be planned, so load all rooms first.
+                # Space children then come from the state of each space.
+                with self.metrics.phase("room_state"):
+                    async for room in iter_rooms(self.client, self.mxid, limit = self.space_fetch_concurrency):
+                        self.client.rooms[room.room_id] = room
+            else:
+                # Sync fetches rooms
+                with self.metrics.phase("sync"):
+                    sync_filter = await get_sync_filter(self.client, store = self.store) if self.use_sync_filter else None
+                    if self.store != None:
+                        sync_response = await self.store.sync(self.client, set_presence="offline", sync_filter=sync_filter)
+                    else:
+                        sync_response = await self.client.sync(set_presence="offline", sync_filter=sync_filter)
+                self.sync_response = sync_response
+                self.sync_complete = self.store == None or self.store.changed_rooms == None
+                # Strategies asking for bridges of a room do not need to fetch its state again
+                bridge_cache.update_from_sync(sync_response, complete = self.sync_complete)
             # Collect and categorize spaces and rooms
-            await self.build_room_space_cache()
+            with self.metrics.phase("space_index"):
+                await self.build_room_space_cache()
+            if self.load_space_hierarchy:
+                with self.metrics.phase("space_hierarchy"):
+                    await self.build_space_hierarchy()
             # Process rooms
             planned_additions = []
             planned_removals = []
+            if self.strategy.batch_size != None:
+                # Also for live updates in ongoing mode, which are decided as chunks of one room
+                self.pool = make_process_pool(self.batch_processes)
 
-            if initial:
+            if initial and not ongoing:
                 print("Doing initial space management for all rooms...")
-                for room in self.client.rooms.values():
-                    pa, pr = await self.handle_room(room)
-                    planned_additions += pa
-                    planned_removals += pr
-
-                print("-"*42)
-                await self.print_planned_changes(planned_additions, planned_removals)
-                print("-"*42)
-                if not ongoing:
-                    input("Enter to execute")
-                await self.exec_planned_changes(planned_additions, planned_removals)
+                addition_count = 0
+                removal_count = 0
+                if plan_path != None:
+                    plan_writer = PlanWriter(plan_path)
+                if self.strategy.batch_size != None:
+                    room_groups = chunks(self.client.rooms.values(), self.strategy.batch_size)
+                    handle_group = self.handle_rooms
+                else:
+                    room_groups = self.client.rooms.values()
+                    handle_group = self.handle_room
+                with self.metrics.phase("planning"):
+                    for group in room_groups:
+                        pa, pr = await handle_group(group)
+                        addition_count += len(pa)
+                        removal_count += len(pr)
+                        if plan_writer != None:
+                            self.write_planned_changes(plan_writer, pa, pr)
+                        else:
+                            planned_additions += pa
+                            planned_removals += pr
+                self.metrics.set_value("rooms", len(self.client.rooms))
+                self.metrics.set_value("spaces", len(self.space_index))
+                self.metrics.set_value("planned_additions", addition_count)
+                self.metrics.set_value("planned_removals", removal_count)
+                self.metrics.record_planning(self.member_source, self.decision_cache)
+
+                self.member_source.print_summary()
+                if self.decision_cache != None and self.strategy.decision_inputs != None:
+                    self.decision_cache.print_summary()
+                if plan_writer != None:
+                    plan_writer.close()
+                else:
+                    print("-"*42)
+                    await self.print_planned_changes(planned_additions, planned_removals)
+                    print("-"*42)
+                    if confirm and not ongoing:
+                        input("Enter to execute")
+                    await self.exec_planned_changes(planned_additions, planned_removals)
+                    self.writer.print_summary()
+
+            if self.store != None and not (initial and ongoing):
+                self.store.commit()
+                # Member snapshots only help on startup, live events always need fresh members
+                self.store.changed_rooms = None
 
             if ongoing:
+                self.queue = RoomWorkQueue(self.process_queued_room, self.room_workers, self.metrics)
+                self.queue.start()
+                if initial:
+                    # The initial pass shares the queue with live updates, which go first
+                    print("Doing initial space management for all rooms while listening to changes...")
+                    for room_id in list(self.client.rooms):
+                        self.queue.put(room_id, BACKLOG)
+                    self.backlog_task = asyncio.ensure_future(self.finish_backlog())
                 print("Start listening to room/space changes to update affected rooms only...")
                 # Listen to room member events: these are sent on room joins, and some spaces might depend on joined members as well,
                 # so recategorize rooms on member events.
                 self.client.add_event_callback(self.handle_room_update, (RoomMemberEvent,))
                 # We need to update our room/space cache on space changes. Also, we want to do a room update after that as well.
                 self.client.add_event_callback(self.handle_space_update, (SpaceChildEvent,))
-                await self.client.sync_forever(timeout=30000, full_state=True, set_presence="offline")
+                self.client.add_event_callback(self.handle_power_levels_update, (PowerLevelsEvent,))
+                self.live_sync_filter = await get_sync_filter(self.client, timeline = True, store = self.store) if self.use_sync_filter else None
+                if self.full_resync_interval != None:
+                    self.resync_task = asyncio.ensure_future(self.resync_periodically())
+                # Continues from the token of the initial sync, later syncs only carry changes
+                await self.sync_forever()
 
         finally:
+            if self.resync_task != None:
+                self.resync_task.cancel()
+            if self.backlog_task != None:
+                self.backlog_task.cancel()
+            if self.queue != None:
+                await self.queue.stop()
+                for name, value in self.queue.stats().items():
+                    self.metrics.set_value(f"queue_{name}", value)
+                self.writer.print_summary()
+            if self.pool != None:
+                self.pool.shutdown()
+                self.pool = None
+            if plan_writer != None:
+                plan_writer.close()
+            if self.report_path != None:
+                self.metrics.set_value("coalesced_events", self.coalesced_event_count)
+                self.metrics.set_value("suppressed_echoes", self.suppressed_echo_count)
+                self.metrics.set_value("via_queries", self.via_servers.queries)
+                self.metrics.set_value("state_gaps", self.state_gap_count)
+                self.metrics.set_value("full_resyncs", self.full_resync_count)
+                self.metrics.set_value("via_room_builds", self.via_servers.builds)
+                self.metrics.write_report(self.report_path)
+            if self.store != None:
+                self.store.close()
             if self.token == None:
                 try:
                     await self.client.logout()
                 except:
                     pass
+            if self.client_session != None:
+                # Owned by the caller
+                self.client.client_session = None
             try:
                 await self.client.close()
             except:
                 pass
 
+    async def process_queued_room(self, room_id, priority):
+        room = self.client.rooms.get(room_id)
+        if room == None:
+            print(f"Room {room_id} not found")
+            return
+        with self.metrics.phase("live_update" if priority == LIVE else "planning"):
+            await self.update_room(room)
+
+    async def finish_backlog(self):
+        start_time = time.monotonic()
+        await self.queue.join(BACKLOG)
+        print(f"Initial space management done in {time.monotonic() - start_time:.2f}s")
+        self.queue.print_summary()
+        self.writer.print_summary()
+        self.member_source.print_summary()
+        if self.decision_cache != None and self.strategy.decision_inputs != None:
+            self.decision_cache.print_summary()
+        self.metrics.set_value("rooms", len(self.client.rooms))
+        self.metrics.set_value("spaces", len(self.space_index))
+        self.metrics.record_planning(self.member_source, self.decision_cache)
+        if self.store != None:
+            self.store.commit()
+            # Member snapshots only help on startup, live events always need fresh members
+            self.store.changed_rooms = None
+
     async def get_room_list_for_space(self, space):
         room_list = []
         result = await self.client.room_get_state(room_id = space.room_id)
@@ -171,53 +510,228 @@ class RoomSpaceController:
         return room_list
 
     async def build_room_space_cache(self):
-        # Also build spaces cache
-        self.spaces_cache = []
-        for room in self.client.rooms.values():
-            if room.room_type == "m.space":
-                if VERBOSE:
-                    print(f"Found space {room.room_id} {room.display_name}")
-                self.spaces_cache.append(room)
-        # Rooms in selected spaces
-        for space in self.spaces_cache:
+        # Also build spaces cache. The new index replaces the current one once it is complete,
+        # changes made to the current one meanwhile are applied to it again.
+        space_index = RoomSpaceIndex()
+        self.space_index_changes = []
+        try:
+            for room in self.client.rooms.values():
+                if room.room_type == "m.space":
+                    if VERBOSE:
+                        print(f"Found space {room.room_id} {room.display_name}")
+                    space_index.add_space(room)
+            # Rooms in selected spaces.
+            # Space states are fetched concurrently, but merged into the cache one after another.
+            spaces = space_index.get_all_spaces()
+            print(f"Loading state of {len(spaces)} spaces...")
+            start_time = time.monotonic()
+            loaded = 0
+            child_count = 0
+            self.space_state_fetch_count = 0
+            async for space, room_list in bounded_map(self.get_space_with_room_list, spaces, self.space_fetch_concurrency):
+                space_index.set_children(space.room_id, room_list)
+                loaded += 1
+                child_count += len(room_list)
+                if VERBOSE and (loaded % 50 == 0 or loaded == len(spaces)):
+                    print(f"Loaded {loaded}/{len(spaces)} spaces")
+            for name, args in self.space_index_changes:
+                getattr(space_index, name)(*args)
+            self.space_index = space_index
+        finally:
+            self.space_index_changes = None
+        print(f"Loaded {child_count} space children from {loaded} spaces ({self.space_state_fetch_count} fetched from the server) in {time.monotonic() - start_time:.2f}s")
+
+    async def build_space_hierarchy(self):
+        # Joined spaces are known from the index already, /hierarchy adds the sub-spaces below them.
+        # Like the index, the new hierarchy replaces the current one once it is complete.
+        hierarchy = SpaceHierarchy()
+        space_ids = [space.room_id for space in self.space_index.get_all_spaces()]
+        for space_id in space_ids:
+            hierarchy.set_children(space_id, self.space_index.get_children(space_id))
+        start_time = time.monotonic()
+        fetched = await load_hierarchies(self.client, hierarchy, space_ids, self.space_fetch_concurrency, metrics = self.metrics)
+        # Our own view of joined spaces is more current than the server's walk
+        for space in self.space_index.get_all_spaces():
+            hierarchy.set_children(space.room_id, self.space_index.get_children(space.room_id))
+        self.hierarchy = hierarchy
+        print(f"Loaded hierarchy of {fetched} spaces in {time.monotonic() - start_time:.2f}s")
+        self.hierarchy.print_summary()
+        self.metrics.set_value("hierarchy_spaces", len(self.hierarchy))
+        self.metrics.set_value("hierarchy_cycles", len(self.hierarchy.cycle_edges))
+
+    async def get_space_with_room_list(self, space):
+        if self.store != None and not self.store.room_changed(space.room_id) and self.store.has_space_children(space.room_id):
+            return space, self.store.load_space_children(space.room_id)
+        room_list = self.get_room_list_for_space_from_sync(space)
+        if room_list == None:
+            self.space_state_fetch_count += 1
             room_list = await self.get_room_list_for_space(space)
-            for room_id in room_list:
-                if room_id in self.room_space_cache:
-                    self.room_space_cache[room_id].append(space)
-                else:
-                    self.room_space_cache[room_id] = [space]
+        if self.store != None:
+            self.store.save_space_children(space.room_id, room_list)
+        return space, room_list
+
+    def get_room_list_for_space_from_sync(self, space):
+        # Returns None if the sync did not contain the complete list of children
+        if self.space_children_source != "sync" or self.sync_response == None:
+            return None
+        room_info = self.sync_response.rooms.join.get(space.room_id)
+        if room_info == None:
+            return None
+        events = [event.source for event in list(room_info.state) + list(room_info.timeline.events)]
+        if self.sync_complete:
+            return sorted(apply_space_child_events(set(), events))
+        if self.store != None and self.store.has_space_children(space.room_id):
+            # Incremental sync: apply the changes since the last run
+            return sorted(apply_space_child_events(set(self.store.load_space_children(space.room_id)), events))
+        return None
+
+    async def handle_sync_response(self, response):
+        bridge_cache.update_from_sync(response)
+        if self.store != None:
+            self.store.handle_sync_response(self.client, response)
+            self.store.commit(response.next_batch)
+        for room_id in response.rooms.leave:
+            if self.space_index.has_space(room_id) or self.space_index_changes != None:
+                self.change_space_index("remove_space", room_id)
+            self.via_servers.forget_room(room_id)
+        for room_id, room_info in response.rooms.join.items():
+            # Events in the state section do not reach the event callbacks. It holds the state changes
+            # before the timeline, which matter when the timeline was limited.
+            state_events = [event.source for event in room_info.state]
+            if len(state_events) > 0 or room_info.timeline.limited:
+                self.handle_state_gap(room_id, state_events, room_info.timeline.limited)
+
+    def handle_state_gap(self, room_id, state_events, limited):
+        room = self.client.rooms.get(room_id)
+        if room == None:
+            return
+        for event in state_events:
+            if event.get("type") == "m.space.child" and "state_key" in event:
+                if self.apply_space_child(room, event["state_key"], event.get("content")) and event["state_key"] in self.client.rooms:
+                    self.schedule_room_update(self.client.rooms[event["state_key"]])
+        if limited or any(event.get("type") == "m.room.member" for event in state_events):
+            # Members may have changed without events, count them again when needed
+            self.via_servers.forget_room(room_id)
+        if limited:
+            self.state_gap_count += 1
+            self.schedule_room_update(room)
+
+    async def sync_forever(self):
+        # Like client.sync_forever, but full_resync can ask for the full state in the next sync.
+        # Syncs must not overlap, they would race on the sync token and the room state.
+        while True:
+            full_state = self.full_resync_requested
+            self.full_resync_requested = False
+            if full_state:
+                print("Syncing the full state of all rooms...")
+            try:
+                response = await self.client.sync(timeout = 0 if full_state else 30000, full_state = full_state, set_presence = "offline", sync_filter = self.live_sync_filter)
+            except Exception as e:
+                response = e
+            if not isinstance(response, SyncResponse):
+                print(f"Sync failed: {response}")
+                if full_state:
+                    self.full_resync_requested = True
+                await asyncio.sleep(5)
+                continue
+            await self.handle_sync_response(response)
+            if full_state:
+                await self.apply_full_state(response)
+
+    def full_resync(self):
+        # Recovery: get the full state of all rooms with the next sync and re-evaluate everything
+        self.full_resync_requested = True
+
+    async def apply_full_state(self, response):
+        self.full_resync_count += 1
+        with self.metrics.phase("full_resync"):
+            self.sync_response = response
+            self.sync_complete = True
+            bridge_cache.update_from_sync(response, complete = True)
+            # Rooms being planned keep the index they started with, and no new ones start until
+            # the new index and hierarchy are in place
+            self.queue.pause()
+            try:
+                await self.queue.wait_idle()
+                await self.build_room_space_cache()
+                if self.load_space_hierarchy:
+                    await self.build_space_hierarchy()
+                self.via_servers.clear()
+                if self.store != None:
+                    self.store.changed_rooms = None
+                for room_id in list(self.client.rooms):
+                    self.queue.put(room_id, BACKLOG)
+            finally:
+                self.queue.resume()
+
+    async def resync_periodically(self):
+        while True:
+            await asyncio.sleep(self.full_resync_interval)
+            self.full_resync()
 
     async def handle_room_update(self, room, event):
-        if room.room_type == "m.space" and room not in self.spaces_cache:
+        if room.room_type == "m.space" and not self.space_index.has_space(room.room_id):
             if VERBOSE:
                 print(f"NEW SPACE {room}")
-            self.spaces_cache.append(room)
+            self.change_space_index("add_space", room)
         if VERBOSE:
             print(f"ROOM EVENT {event}")
+        if isinstance(event, RoomMemberEvent):
+            self.via_servers.handle_member_event(room.room_id, event.state_key, event.membership)
+        if isinstance(event, RoomMemberEvent) and self.writer.is_echo(room.room_id, "m.room.member", event.state_key, event.source.get("content"), event.sender, event.event_id):
+            self.suppress_echo(room.room_id)
+            return
+        self.schedule_room_update(room)
+
+    def suppress_echo(self, room_id):
+        # The index is already updated, the room was evaluated before writing
+        self.suppressed_echo_count += 1
+        self.metrics.count("suppressed_echoes")
+        print(f"Skipped echo of own write in {room_id} ({self.suppressed_echo_count} skipped in total)")
+
+    def schedule_room_update(self, room):
+        # Collapse all events for a room within the debounce window into a single re-evaluation
+        room_id = room.room_id
+        if room_id in self.dirty_rooms:
+            self.dirty_rooms[room_id] += 1
+            return
+        self.dirty_rooms[room_id] = 1
+        task = asyncio.ensure_future(self.flush_room_update(room_id))
+        self.room_update_tasks.add(task)
+        task.add_done_callback(self.room_update_tasks.discard)
+
+    async def flush_room_update(self, room_id):
+        await asyncio.sleep(self.debounce_seconds)
+        event_count = self.dirty_rooms.pop(room_id)
+        if event_count > 1:
+            self.coalesced_event_count += event_count - 1
+            self.metrics.count("coalesced_events", event_count - 1)
+            print(f"Coalesced {event_count} events for {room_id} ({self.coalesced_event_count} coalesced in total)")
+        self.queue.put(room_id, LIVE)
+
+    async def update_room(self, room):
         planned_additions, planned_removals = await self.handle_room(room)
+        if len(planned_additions) == 0 and len(planned_removals) == 0:
+            return
         print("-"*42)
         await self.print_planned_changes(planned_additions, planned_removals)
         print("-"*42)
         await self.exec_planned_changes(planned_additions, planned_removals)
 
+    async def handle_power_levels_update(self, room, event):
+        if self.via_servers.is_tracked(room.room_id):
+            self.via_servers.set_power_levels(room.room_id, event.power_levels.users)
+
     async def handle_space_update(self, space, event):
         if VERBOSE:
             print(f"SPACE EVENT {event}")
         # Update cache
         room_id = event.state_key
         content = event.content
-        if content != None and len(content) > 0:
-            # room_id added to space
-            if room_id in self.room_space_cache:
-                if space not in self.room_space_cache[room_id]:
-                    self.room_space_cache[room_id].append(space)
-            else:
-                self.room_space_cache[room_id] = [space]
-        else:
-            # room_id removed from space
-            if room_id in self.room_space_cache:
-                if space in self.room_space_cache[room_id]:
-                    self.room_space_cache[room_id].remove(space)
+        self.apply_space_child(space, room_id, content)
+        if self.writer.is_echo(space.room_id, "m.space.child", room_id, content, event.sender, event.event_id):
+            self.suppress_echo(room_id)
+            return
         # Handle_room update for child
         try:
             room = self.client.rooms[room_id]
@@ -225,10 +739,37 @@ class RoomSpaceController:
         except KeyError:
             print(f"Room {event.state_key} not found")
 
+    def apply_space_child(self, space, room_id, content):
+        # Returns whether the index changed
+        if not self.space_index.has_space(space.room_id):
+            self.change_space_index("add_space", space)
+        if content != None and len(content) > 0:
+            # room_id added to space
+            changed = self.change_space_index("add_child", space.room_id, room_id)
+            if self.load_space_hierarchy:
+                self.hierarchy.add_child(space.room_id, room_id)
+            if self.store != None:
+                self.store.add_space_child(space.room_id, room_id)
+        else:
+            # room_id removed from space
+            changed = self.change_space_index("remove_child", space.room_id, room_id)
+            if self.load_space_hierarchy:
+                self.hierarchy.remove_child(space.room_id, room_id)
+            if self.store != None:
+                self.store.remove_space_child(space.room_id, room_id)
+        return changed
+
+    def change_space_index(self, name, *args):
+        # Calls a RoomSpaceIndex method. While build_room_space_cache builds a new index, the call is
+        # recorded to be applied to the new index too, which may not have seen the change.
+        if self.space_index_changes != None:
+            self.space_index_changes.append((name, args))
+        return getattr(self.space_index, name)(*args)
+
     async def get_space_from_id(self, space_id):
-        for space in self.spaces_cache:
-            if space_id == space.room_id:
-                return space
+        space = self.space_index.get_space(space_id)
+        if space != None:
+            return space
         raise RuntimeError(f"Did not find space with id {space_id}")
 
     async def get_space_list_for_room(self, room, use_cache=True):
@@ -237,13 +778,10 @@ class RoomSpaceController:
                 room_id = room
             else:
                 room_id = room.room_id
-            if room_id in self.room_space_cache:
-                return self.room_space_cache[room_id]
-            else:
-                return []
+            return self.space_index.get_spaces_for_room(room_id)
         else:
             result = []
-            for space in self.spaces_cache:
+            for space in self.space_index.get_all_spaces():
                 if await self.is_room_in_space(space, room):
                     result.append(space)
             return result
@@ -282,17 +820,14 @@ class RoomSpaceController:
             room_id = room
         else:
             room_id = room.room_id
-        event_dict = AddSpaceChildBuilder(
-                room_id = room_id,
-                via_servers = via_servers,
-                auto_join = False,
-                suggested = False
-        ).as_dict()
-        await self.client.room_put_state(
+        event_dict = space_child_add_event(room_id, via_servers)
+        # Queued in the write scheduler, await the returned task for the result
+        return self.writer.put_state(
             room_id = space_id,
             event_type = event_dict["type"],
             content = event_dict["content"],
-            state_key = event_dict["state_key"]
+            state_key = event_dict["state_key"],
+            label = f"add {room_id} to {space_id}"
         )
 
     async def remove_room_from_space(self, space, room):
@@ -304,16 +839,15 @@ class RoomSpaceController:
             room_id = room
         else:
             room_id = room.room_id
-        event_dict = RemoveSpaceChildBuilder(
-                room_id = room_id,
-        ).as_dict()
-        await self.client.room_put_state(
+        event_dict = space_child_remove_event(room_id)
+        return self.writer.put_state(
             room_id = space_id,
             event_type = event_dict["type"],
             content = event_dict["content"],
-            state_key = event_dict["state_key"]
+            state_key = event_dict["state_key"],
+            label = f"remove {room_id} from {space_id}"
         )
 
-def space_manage(strategy, homeserver, mxid, passwd = None, script_device_id = "RS-SCRIPT", device_name = "", token = None, initial = True, ongoing = False):
-    rsc = RoomSpaceController(strategy, homeserver, mxid, passwd = passwd, script_device_id = script_device_id, device_name = device_name, token = token)
-    asyncio.get_event_loop().run_until_complete(rsc.exec_space_manage(initial = initial, ongoing = ongoing))
+def space_manage(strategy, homeserver, mxid, passwd = None, script_device_id = "RS-SCRIPT", device_name = "", token = None, initial = True, ongoing = False, space_fetch_concurrency = 8, store_path = None, use_sync_filter = True, debounce_seconds = 2.0, write_concurrency = 4, write_rate = 5.0, decision_cache_size = 4096, space_children_source = "sync", member_source = "hybrid", report_path = None, metrics = None, confirm = True, planning_source = "sync", plan_path = None, load_space_hierarchy = False, batch_processes = 0, room_workers = 4, full_resync_interval = None):
+    rsc = RoomSpaceController(strategy, homeserver, mxid, passwd = passwd, script_device_id = script_device_id, device_name = device_name, token = token, space_fetch_concurrency = space_fetch_concurrency, store_path = store_path, use_sync_filter = use_sync_filter, debounce_seconds = debounce_seconds, write_concurrency = write_concurrency, write_rate = write_rate, decision_cache_size = decision_cache_size, space_children_source = space_children_source, member_source = member_source, report_path = report_path, metrics = metrics, planning_source = planning_source, load_space_hierarchy = load_space_hierarchy, batch_processes = batch_processes, room_workers = room_workers, full_resync_interval = full_resync_interval)
+    asyncio.get_event_loop().run_until_complete(rsc.exec_space_manage(initial = initial, ongoing = ongoing, confirm = confirm, plan_path = plan_path))
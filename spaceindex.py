@@ -0,0 +1,92 @@
+# Bidirectional index of which rooms are in which spaces.
+# All updates and lookups are constant time per changed edge.
+class RoomSpaceIndex:
+    def __init__(self):
+        # space id -> space room
+        self.spaces = dict()
+        # room id -> set of space ids
+        self.room_spaces = dict()
+        # space id -> set of child room ids
+        self.space_children = dict()
+
+    def __len__(self):
+        return len(self.spaces)
+
+    def add_space(self, space):
+        self.spaces[space.room_id] = space
+        if space.room_id not in self.space_children:
+            self.space_children[space.room_id] = set()
+
+    def remove_space(self, space_id):
+        self.spaces.pop(space_id, None)
+        for room_id in self.space_children.pop(space_id, set()):
+            self._discard_room_space(room_id, space_id)
+
+    def has_space(self, space_id):
+        return space_id in self.spaces
+
+    def get_space(self, space_id):
+        return self.spaces.get(space_id)
+
+    def get_all_spaces(self):
+        return list(self.spaces.values())
+
+    def add_child(self, space_id, room_id):
+        # Returns whether the index changed
+        children = self.space_children.setdefault(space_id, set())
+        if room_id in children:
+            return False
+        children.add(room_id)
+        self.room_spaces.setdefault(room_id, set()).add(space_id)
+        return True
+
+    def remove_child(self, space_id, room_id):
+        # Returns whether the index changed
+        children = self.space_children.get(space_id)
+        if children == None or room_id not in children:
+            return False
+        children.remove(room_id)
+        self._discard_room_space(room_id, space_id)
+        return True
+
+    def set_children(self, space_id, room_ids):
+        room_ids = set(room_ids)
+        old_room_ids = self.space_children.get(space_id, set())
+        for room_id in old_room_ids - room_ids:
+            self.remove_child(space_id, room_id)
+        for room_id in room_ids - old_room_ids:
+            self.add_child(space_id, room_id)
+
+    def get_children(self, space_id):
+        return self.space_children.get(space_id, set())
+
+    def get_space_ids_for_room(self, room_id):
+        return self.room_spaces.get(room_id, set())
+
+    def get_spaces_for_room(self, room_id):
+        # Sorted for deterministic output. Spaces we know only from the index but have not joined are left out.
+        return [self.spaces[space_id] for space_id in sorted(self.get_space_ids_for_room(room_id)) if space_id in self.spaces]
+
+    def _discard_room_space(self, room_id, space_id):
+        spaces = self.room_spaces.get(room_id)
+        if spaces != None:
+            spaces.discard(space_id)
+            if len(spaces) == 0:
+                del self.room_spaces[room_id]
+
+def apply_space_child_events(children, events):
+    # Update the set of child room ids of a space from m.space.child state events, given as dicts.
+    # A child without content has been removed from the space.
+    for event in events:
+        try:
+            if event["type"] != "m.space.child":
+                continue
+            room_id = event["state_key"]
+            content = event["content"]
+        except KeyError as e:
+            continue
+        if content != None and len(content) > 0:
+            children.add(room_id)
+        else:
+            children.discard(room_id)
+    return children
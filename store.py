@@ -0,0 +1,190 @@
+import sqlite3
+
+from .util import client_package, is_error_response
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    room_type TEXT,
+    name TEXT,
+    canonical_alias TEXT,
+    members_fetched INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS members (
+    room_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    display_name TEXT,
+    avatar_url TEXT,
+    PRIMARY KEY (room_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS space_children (
+    space_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    PRIMARY KEY (space_id, room_id)
+);
+"""
+
+# Bumped when stored data from older versions must not be reused.
+# 2: members only hold joined users, no invited ones
+STORE_VERSION = "2"
+
+# On-disk cache of sync token, room snapshots, member lists and space children,
+# so a later run can continue with an incremental sync
+class SyncStore:
+    def __init__(self, path, mxid):
+        self.path = path
+        self.mxid = mxid
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        # Rooms that changed in the latest sync, None if everything needs to be refreshed
+        self.changed_rooms = None
+        self.pending_next_batch = None
+        if self.get_value("mxid") != None and (self.get_value("mxid") != mxid or self.get_value("version") != STORE_VERSION):
+            # Cache of a different account or version, do not reuse
+            self.clear()
+        else:
+            self.set_value("mxid", mxid)
+            self.set_value("version", STORE_VERSION)
+
+    def clear(self):
+        for table in ["meta", "rooms", "members", "space_children"]:
+            self.db.execute(f"DELETE FROM {table}")
+        # Keep the account and version so the cleared store is reused
+        self.set_value("mxid", self.mxid)
+        self.set_value("version", STORE_VERSION)
+        self.db.commit()
+
+    def get_value(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row == None else row[0]
+
+    def set_value(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_next_batch(self):
+        return self.get_value("next_batch")
+
+    def set_next_batch(self, next_batch):
+        self.set_value("next_batch", next_batch)
+
+    def room_changed(self, room_id):
+        return self.changed_rooms == None or room_id in self.changed_rooms
+
+    def save_room(self, room):
+        self.db.execute(
+            "INSERT OR REPLACE INTO rooms (room_id, room_type, name, canonical_alias, members_fetched) VALUES (?, ?, ?, ?, 0)",
+            (room.room_id, room.room_type, room.name, room.canonical_alias)
+        )
+        # Until members are fetched, keep what sync told us about joined members.
+        # room.users also holds invited users, which are restored as joined otherwise.
+        invited_users = getattr(room, "invited_users", dict())
+        self.db.execute("DELETE FROM members WHERE room_id = ?", (room.room_id,))
+        self.db.executemany(
+            "INSERT INTO members (room_id, user_id, display_name, avatar_url) VALUES (?, ?, ?, ?)",
+            [(room.room_id, user.user_id, user.display_name, user.avatar_url) for user_id, user in room.users.items() if user_id not in invited_users]
+        )
+
+    def forget_room(self, room_id):
+        self.db.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+        self.db.execute("DELETE FROM members WHERE room_id = ?", (room_id,))
+        self.db.execute("DELETE FROM space_children WHERE space_id = ?", (room_id,))
+        self.db.execute("DELETE FROM meta WHERE key = ?", (f"space_loaded:{room_id}",))
+
+    def restore_rooms(self, client):
+        MatrixRoom = client_package(client).MatrixRoom
+        for room_id, room_type, name, canonical_alias in self.db.execute("SELECT room_id, room_type, name, canonical_alias FROM rooms"):
+            room = MatrixRoom(room_id, self.mxid)
+            room.room_type = room_type
+            room.name = name
+            room.canonical_alias = canonical_alias
+            for user_id, display_name, avatar_url in self.db.execute("SELECT user_id, display_name, avatar_url FROM members WHERE room_id = ?", (room_id,)):
+                room.add_member(user_id, display_name, avatar_url)
+            client.rooms[room_id] = room
+
+    def save_members(self, room_id, members):
+        self.db.execute("DELETE FROM members WHERE room_id = ?", (room_id,))
+        self.db.executemany(
+            "INSERT INTO members (room_id, user_id, display_name, avatar_url) VALUES (?, ?, ?, ?)",
+            [(room_id, member.user_id, member.display_name, member.avatar_url) for member in members]
+        )
+        self.db.execute("UPDATE rooms SET members_fetched = 1 WHERE room_id = ?", (room_id,))
+
+    def load_members(self, room_id, member_class):
+        # member_class: RoomMember of the client's package
+        row = self.db.execute("SELECT members_fetched FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+        if row == None or not row[0]:
+            return None
+        return [
+            member_class(user_id, display_name, avatar_url)
+            for user_id, display_name, avatar_url in self.db.execute("SELECT user_id, display_name, avatar_url FROM members WHERE room_id = ?", (room_id,))
+        ]
+
+    def has_space_children(self, space_id):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (f"space_loaded:{space_id}",)).fetchone()
+        return row != None
+
+    def save_space_children(self, space_id, room_ids):
+        self.db.execute("DELETE FROM space_children WHERE space_id = ?", (space_id,))
+        self.db.executemany("INSERT INTO space_children (space_id, room_id) VALUES (?, ?)", [(space_id, room_id) for room_id in room_ids])
+        self.set_value(f"space_loaded:{space_id}", "1")
+
+    def load_space_children(self, space_id):
+        return [row[0] for row in self.db.execute("SELECT room_id FROM space_children WHERE space_id = ?", (space_id,))]
+
+    def add_space_child(self, space_id, room_id):
+        self.db.execute("INSERT OR IGNORE INTO space_children (space_id, room_id) VALUES (?, ?)", (space_id, room_id))
+
+    def remove_space_child(self, space_id, room_id):
+        self.db.execute("DELETE FROM space_children WHERE space_id = ? AND room_id = ?", (space_id, room_id))
+
+    def handle_sync_response(self, client, response):
+        # Remember which rooms changed, and keep snapshots of them
+        for room_id in response.rooms.leave:
+            self.forget_room(room_id)
+            client.rooms.pop(room_id, None)
+        for room_id in response.rooms.join:
+            if room_id in client.rooms:
+                self.save_room(client.rooms[room_id])
+            if self.changed_rooms != None:
+                self.changed_rooms.add(room_id)
+
+    def commit(self, next_batch = None):
+        if next_batch != None:
+            self.pending_next_batch = next_batch
+        if self.pending_next_batch != None:
+            self.set_next_batch(self.pending_next_batch)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    async def sync(self, client, **kwargs):
+        # Initial sync that resumes from the stored sync token if there is one.
+        # Only rooms in self.changed_rooms need to be refreshed afterwards.
+        since = self.get_next_batch()
+        response = None
+        if since != None:
+            self.restore_rooms(client)
+            self.changed_rooms = set()
+            response = await client.sync(since = since, **kwargs)
+            if is_error_response(response):
+                print(f"Incremental sync failed, doing full sync: {response}")
+                client.rooms.clear()
+                response = None
+        if response == None:
+            self.clear()
+            self.changed_rooms = None
+            response = await client.sync(**kwargs)
+            if is_error_response(response):
+                return response
+        self.handle_sync_response(client, response)
+        # Only store the new token once the caller is done with the changed rooms, see commit()
+        self.pending_next_batch = response.next_batch
+        if self.changed_rooms != None:
+            print(f"Resumed from previous run, {len(self.changed_rooms)} rooms changed")
+        return response
@@ -0,0 +1,43 @@
+import asyncio
+
+from .util import bounded_map, client_package, is_error_response
+
+
+# Loading rooms without /sync, for one-shot runs: /joined_rooms, then only the state events
+# the scripts need per room. The returned rooms only know our own member, so members need
+# to be fetched remotely. Works with nio and mnio clients, rooms are of the client's package.
+
+async def get_joined_room_ids(client):
+    response = await client.joined_rooms()
+    try:
+        return response.rooms
+    except AttributeError:
+        raise RuntimeError(f"Could not get joined rooms: {response}")
+
+async def get_state_content(client, room_id, event_type, state_key = ""):
+    response = await client.room_get_state_event(room_id = room_id, event_type = event_type, state_key = state_key)
+    if is_error_response(response):
+        return None
+    return getattr(response, "content", None)
+
+async def load_room(client, mxid, room_id):
+    create, name, alias, member = await asyncio.gather(
+        get_state_content(client, room_id, "m.room.create"),
+        get_state_content(client, room_id, "m.room.name"),
+        get_state_content(client, room_id, "m.room.canonical_alias"),
+        get_state_content(client, room_id, "m.room.member", mxid),
+    )
+    room = client_package(client).MatrixRoom(room_id, mxid)
+    room.room_type = create.get("type") if create != None else None
+    room.name = name.get("name") if name != None else None
+    room.canonical_alias = alias.get("alias") if alias != None else None
+    if member != None:
+        room.add_member(mxid, member.get("displayname"), member.get("avatar_url"))
+    return room
+
+async def iter_rooms(client, mxid, room_ids = None, limit = 8):
+    # Yields rooms in /joined_rooms order, while loading up to limit rooms at once
+    if room_ids == None:
+        room_ids = await get_joined_room_ids(client)
+    async for room in bounded_map(lambda room_id: load_room(client, mxid, room_id), room_ids, limit):
+        yield room
@@ -1,5 +1,7 @@
 import asyncio
+import hashlib
 import inspect
+import json
 import os
 import sys
 
@@ -8,7 +10,84 @@ def add_lib_path(lib_dir):
     if lib_dir not in sys.path:
         sys.path.insert(0, lib_dir)
 
-async def get_bridges(client, room):
+BRIDGE_EVENT_TYPES = ["m.bridge", "uk.half-shot.bridge"]
+
+# Bridge state per room, filled from sync where possible and from /state otherwise
+class BridgeCache:
+    def __init__(self):
+        # room id -> {(event type, state key): content}
+        self.rooms = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_cached(self, room_id):
+        if room_id not in self.rooms:
+            return None
+        return [content for content in self.rooms[room_id].values()]
+
+    def set_bridges(self, room_id, events):
+        self.rooms[room_id] = dict()
+        for event in events:
+            self.update_bridge(room_id, event)
+
+    def update_bridge(self, room_id, event):
+        # event: state event as dict, as returned by /state or found in event.source
+        try:
+            if event["type"] not in BRIDGE_EVENT_TYPES or room_id not in self.rooms:
+                return
+            key = (event["type"], event["state_key"])
+            content = event["content"]
+        except KeyError as e:
+            return
+        if content != None and len(content) > 0:
+            self.rooms[room_id][key] = content
+        else:
+            self.rooms[room_id].pop(key, None)
+
+    def invalidate(self, room_id):
+        self.rooms.pop(room_id, None)
+
+    def update_from_sync(self, response, complete = False):
+        # complete: the sync has the full state of the rooms in it, i.e. it is an initial sync.
+        # Otherwise only rooms we already know are updated.
+        for room_id, room_info in response.rooms.join.items():
+            if complete:
+                self.rooms[room_id] = dict()
+            for event in list(room_info.state) + list(room_info.timeline.events):
+                self.update_bridge(room_id, event.source)
+        for room_id in response.rooms.leave:
+            self.invalidate(room_id)
+
+    async def get_bridges(self, client, room):
+        if isinstance(room, str):
+            room_id = room
+        else:
+            room_id = room.room_id
+        bridges = self.get_cached(room_id)
+        if bridges != None:
+            self.hits += 1
+            return bridges
+        self.misses += 1
+        result = await client.room_get_state(room_id = room_id)
+        self.set_bridges(room_id, result.events)
+        return self.get_cached(room_id)
+
+    async def get_bridges_for_rooms(self, client, rooms, limit = 8):
+        # room id -> bridges, with at most limit /state requests in flight
+        rooms = [room if isinstance(room, str) else room.room_id for room in rooms]
+        result = dict()
+        async for room_id, bridges in bounded_map(lambda room_id: self._get_bridges_with_id(client, room_id), rooms, limit):
+            result[room_id] = bridges
+        return result
+
+    async def _get_bridges_with_id(self, client, room_id):
+        return room_id, await self.get_bridges(client, room_id)
+
+bridge_cache = BridgeCache()
+
+async def get_bridges(client, room, use_cache = True):
+    if use_cache:
+        return await bridge_cache.get_bridges(client, room)
     if isinstance(room, str):
         room_id = room
     else:
@@ -25,3 +104,85 @@ async def get_bridges(client, room):
         except KeyError as e:
             continue
     return bridges
+
+# The renamer uses nio, space management the mnio fork. Helpers shared by both must not depend on either,
+# so they check responses by duck typing and take classes from the client's own package.
+
+def client_package(client):
+    # The nio or mnio module the client comes from
+    return sys.modules[type(client).__module__.split(".")[0]]
+
+def is_error_response(response):
+    # nio error responses are named like RoomPutStateError, requests may also fail with an exception
+    return isinstance(response, Exception) or type(response).__name__.endswith("Error")
+
+async def bounded_map(func, items, limit):
+    # Run func for all items with at most limit calls in flight, but yield the
+    # results in the order of items, so output stays deterministic
+    semaphore = asyncio.Semaphore(max(1, limit))
+    async def run(item):
+        async with semaphore:
+            return await func(item)
+    tasks = [asyncio.ensure_future(run(item)) for item in items]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# State the scripts look at, everything else is filtered out of syncs
+SYNC_STATE_TYPES = [
+    "m.room.create",
+    "m.room.member",
+    "m.room.name",
+    "m.room.canonical_alias",
+    "m.space.child",
+    # For via servers, see via.ViaServers
+    "m.room.power_levels",
+    "m.bridge",
+    "uk.half-shot.bridge",
+]
+
+def build_sync_filter(timeline = False, lazy_load_members = False):
+    if timeline:
+        # Ongoing syncs need state changes in the timeline to trigger event callbacks
+        timeline_filter = {"types": SYNC_STATE_TYPES}
+    else:
+        timeline_filter = {"limit": 0}
+    return {
+        "presence": {"not_types": ["*"]},
+        "account_data": {"not_types": ["*"]},
+        "room": {
+            "state": {"types": SYNC_STATE_TYPES, "lazy_load_members": lazy_load_members},
+            "timeline": timeline_filter,
+            "ephemeral": {"not_types": ["*"]},
+            "account_data": {"not_types": ["*"]},
+        },
+    }
+
+# (homeserver, user_id, filter hash) -> uploaded filter id
+sync_filter_ids = dict()
+
+async def get_sync_filter(client, timeline = False, lazy_load_members = False, store = None):
+    # Upload the filter once and reuse its id, also across runs if there is a store.
+    # Falls back to sending the filter inline if the upload fails.
+    sync_filter = build_sync_filter(timeline = timeline, lazy_load_members = lazy_load_members)
+    filter_hash = hashlib.sha256(json.dumps(sync_filter, sort_keys=True).encode()).hexdigest()[:16]
+    key = (client.homeserver, client.user_id, filter_hash)
+    if key in sync_filter_ids:
+        return sync_filter_ids[key]
+    filter_id = None
+    if store != None:
+        filter_id = store.get_value(f"filter:{client.homeserver}:{filter_hash}")
+    if filter_id == None:
+        response = await client.upload_filter(**sync_filter)
+        try:
+            filter_id = response.filter_id
+        except AttributeError:
+            print(f"Could not upload sync filter, sending it inline: {response}")
+            return sync_filter
+        if store != None:
+            store.set_value(f"filter:{client.homeserver}:{filter_hash}", filter_id)
+    sync_filter_ids[key] = filter_id
+    return filter_id
@@ -0,0 +1,113 @@
+from collections import Counter
+
+# The spec only picks the server of the highest-powered user if that user can at least moderate
+MIN_POWER_LEVEL = 50
+
+def server_name(user_id):
+    return user_id.split(":", 1)[1] if ":" in user_id else None
+
+# Via servers for rooms, ranked like the spec recommends for room links
+# (https://spec.matrix.org/v1.2/appendices/#routing): the server of the user with the highest
+# power level first if that level is at least 50, then the servers with the most joined members.
+# A room's histogram is built from its member list on the first query and then kept up to date from
+# member and power level events, so queries do not scan the members again.
+# Pass the members the strategy was given: the room itself may only know some of them, e.g. our own
+# member after targeted loading, or with lazy-loaded members.
+class ViaServers:
+    def __init__(self):
+        # room id -> set of joined user ids
+        self.members = dict()
+        # room id -> Counter of joined members per server
+        self.servers = dict()
+        # room id -> {user id: power level} of users above the default level
+        self.power_levels = dict()
+        # room id -> ranked servers, until the room changes
+        self.rankings = dict()
+        self.builds = 0
+        self.queries = 0
+
+    def is_tracked(self, room_id):
+        return room_id in self.members
+
+    def build_room(self, room, members = None):
+        if members != None:
+            self.set_members(room.room_id, [member.user_id for member in members])
+        else:
+            # From the members nio knows, invited users are no members yet
+            invited_users = getattr(room, "invited_users", dict())
+            self.set_members(room.room_id, [user_id for user_id in room.users if user_id not in invited_users])
+        power_levels = getattr(room, "power_levels", None)
+        self.set_power_levels(room.room_id, getattr(power_levels, "users", dict()))
+
+    def set_members(self, room_id, user_ids):
+        self.builds += 1
+        self.members[room_id] = set(user_ids)
+        self.servers[room_id] = Counter(server_name(user_id) for user_id in self.members[room_id])
+        self.rankings.pop(room_id, None)
+
+    def set_power_levels(self, room_id, users):
+        self.power_levels[room_id] = {user_id: level for user_id, level in (users or dict()).items() if level > 0}
+        self.rankings.pop(room_id, None)
+
+    def add_member(self, room_id, user_id):
+        members = self.members.get(room_id)
+        if members == None or user_id in members:
+            return
+        members.add(user_id)
+        self.servers[room_id][server_name(user_id)] += 1
+        self.rankings.pop(room_id, None)
+
+    def remove_member(self, room_id, user_id):
+        members = self.members.get(room_id)
+        if members == None or user_id not in members:
+            return
+        members.remove(user_id)
+        server = server_name(user_id)
+        self.servers[room_id][server] -= 1
+        if self.servers[room_id][server] <= 0:
+            del self.servers[room_id][server]
+        self.rankings.pop(room_id, None)
+
+    def handle_member_event(self, room_id, user_id, membership):
+        # Rooms not queried yet are built from their current members later
+        if membership == "join":
+            self.add_member(room_id, user_id)
+        else:
+            self.remove_member(room_id, user_id)
+
+    def clear(self):
+        self.members.clear()
+        self.servers.clear()
+        self.power_levels.clear()
+        self.rankings.clear()
+
+    def forget_room(self, room_id):
+        self.members.pop(room_id, None)
+        self.servers.pop(room_id, None)
+        self.power_levels.pop(room_id, None)
+        self.rankings.pop(room_id, None)
+
+    def rank(self, room_id):
+        servers = self.servers.get(room_id, Counter())
+        ranking = []
+        power_levels = self.power_levels.get(room_id, dict())
+        if len(power_levels) > 0:
+            # Only servers still in the room can help others join
+            candidates = [(level, servers[server_name(user_id)], user_id) for user_id, level in power_levels.items() if level >= MIN_POWER_LEVEL and servers[server_name(user_id)] > 0]
+            if len(candidates) > 0:
+                ranking.append(server_name(max(candidates)[2]))
+        for server, count in sorted(servers.items(), key = lambda item: (-item[1], item[0])):
+            if server not in ranking:
+                ranking.append(server)
+        return ranking
+
+    def get_via_for_room(self, room, members = None, k = 3):
+        self.queries += 1
+        room_id = room.room_id
+        if not self.is_tracked(room_id):
+            self.build_room(room, members)
+        ranking = self.rankings.get(room_id)
+        if ranking == None:
+            ranking = self.rank(room_id)
+            self.rankings[room_id] = ranking
+        return ranking[:k]
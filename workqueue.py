@@ -0,0 +1,141 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+# Priorities of RoomWorkQueue items, lower goes first
+LIVE = 0
+BACKLOG = 1
+PRIORITY_NAMES = {LIVE: "live", BACKLOG: "backlog"}
+
+# Rooms waiting to be evaluated by a fixed number of workers.
+# Live rooms are taken before backlog rooms, a room is queued at most once and never handled by two
+# workers at the same time: if it is queued again while handled, it runs again afterwards.
+class RoomWorkQueue:
+    def __init__(self, handler, workers = 4, metrics = None):
+        # handler(room_id, priority) is awaited for each item, exceptions are printed
+        self.handler = handler
+        self.worker_count = max(1, workers)
+        self.metrics = metrics
+        # (priority, sequence, room id), entries whose priority does not match self.queued are stale
+        self.heap = []
+        self.sequence = itertools.count()
+        # room id -> (priority, enqueue time)
+        self.queued = dict()
+        # room id -> priority, for rooms queued again while they are handled
+        self.requeued = dict()
+        # room id -> priority of the rooms being handled
+        self.active = dict()
+        self.workers = []
+        self.changed = asyncio.Event()
+        # While paused, rooms can be queued but workers do not take new ones
+        self.paused = False
+        self.processed = {LIVE: 0, BACKLOG: 0}
+        self.max_depth = 0
+        self.total_wait = {LIVE: 0, BACKLOG: 0}
+
+    def __len__(self):
+        return len(self.queued)
+
+    def depth(self, priority = None):
+        if priority == None:
+            return len(self.queued)
+        return sum(1 for queued_priority, _ in self.queued.values() if queued_priority == priority)
+
+    def put(self, room_id, priority = LIVE):
+        if room_id in self.active:
+            self.requeued[room_id] = min(priority, self.requeued.get(room_id, priority))
+            return
+        queued = self.queued.get(room_id)
+        if queued != None:
+            if priority >= queued[0]:
+                return
+            # Promote, the old heap entry becomes stale but the room keeps its waiting time
+            self.queued[room_id] = (priority, queued[1])
+        else:
+            self.queued[room_id] = (priority, time.monotonic())
+        heapq.heappush(self.heap, (priority, next(self.sequence), room_id))
+        self.max_depth = max(self.max_depth, len(self.queued))
+        self.changed.set()
+
+    def start(self):
+        self.workers = [asyncio.ensure_future(self._work()) for i in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions = True)
+        self.workers = []
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.changed.set()
+
+    async def wait_idle(self):
+        # Wait until no room is handled, e.g. after pause
+        while len(self.active) > 0:
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def join(self, priority = None):
+        # Wait until no items of the given priority (or none at all) are queued or handled
+        while self.depth(priority) > 0 or any(priority == None or active_priority == priority for active_priority in self.active.values()):
+            self.changed.clear()
+            await self.changed.wait()
+
+    def _pop(self):
+        while len(self.heap) > 0:
+            priority, _, room_id = heapq.heappop(self.heap)
+            queued = self.queued.get(room_id)
+            if queued == None or queued[0] != priority:
+                continue
+            del self.queued[room_id]
+            return room_id, priority, queued[1]
+        return None
+
+    async def _work(self):
+        while True:
+            item = self._pop() if not self.paused else None
+            if item == None:
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+            room_id, priority, enqueued = item
+            wait = time.monotonic() - enqueued
+            self.total_wait[priority] += wait
+            if self.metrics != None:
+                self.metrics.record_phase(f"queue_wait_{PRIORITY_NAMES[priority]}", wait)
+            self.active[room_id] = priority
+            try:
+                await self.handler(room_id, priority)
+            except Exception as e:
+                print(f"Failed to update {room_id}: {e}")
+            finally:
+                del self.active[room_id]
+                self.processed[priority] += 1
+                if room_id in self.requeued:
+                    self.put(room_id, self.requeued.pop(room_id))
+                # Wake up joiners and idle workers
+                self.changed.set()
+
+    def stats(self):
+        return {
+            "depth": len(self.queued),
+            "live_depth": self.depth(LIVE),
+            "backlog_depth": self.depth(BACKLOG),
+            "active": len(self.active),
+            "max_depth": self.max_depth,
+            "processed_live": self.processed[LIVE],
+            "processed_backlog": self.processed[BACKLOG],
+            "mean_wait_live": self.total_wait[LIVE] / self.processed[LIVE] if self.processed[LIVE] > 0 else 0,
+            "mean_wait_backlog": self.total_wait[BACKLOG] / self.processed[BACKLOG] if self.processed[BACKLOG] > 0 else 0,
+        }
+
+    def print_summary(self):
+        stats = self.stats()
+        print(f"Queue: {stats['depth']} waiting ({stats['live_depth']} live), {stats['active']} active, max {stats['max_depth']} waiting, "
+                f"{stats['processed_live']} live rooms after {stats['mean_wait_live']:.2f}s, {stats['processed_backlog']} backlog rooms after {stats['mean_wait_backlog']:.2f}s on average")
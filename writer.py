@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+from .util import is_error_response
+
+
+def put_state_succeeded(result):
+    # Works for responses of nio and mnio clients alike
+    return not is_error_response(result) and getattr(result, "event_id", None) != None
+
+# Sends state events with bounded concurrency and a token bucket rate limit.
+# Writes with the same order key (by default the room the state is sent to) are sent one after another.
+class WriteScheduler:
+    def __init__(self, client, concurrency = 4, rate = 5.0, burst = 10, max_retries = 5, track_echoes = False, echo_ttl = 300):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        # Set when the homeserver asks us to slow down, holds back all writes
+        self.blocked_until = 0
+        # order key -> latest task for that key
+        self.tails = dict()
+        self.tasks = set()
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self.failures = []
+        # With track_echoes, sync events that are results of our writes can be recognized:
+        # until a write returns by its content, afterwards by the event id the server returned.
+        self.track_echoes = track_echoes
+        # (room id, event type, state key) -> [content, seen] of writes that did not return yet
+        self.inflight_echoes = dict()
+        # event id -> time the write returned. The server may return the id of an identical earlier event
+        # instead of sending a new one, so ids that never show up are dropped after echo_ttl seconds.
+        self.expected_echoes = dict()
+        self.echo_ttl = echo_ttl
+
+    def put_state(self, room_id, event_type, content, state_key = "", label = None, order_key = None):
+        if order_key == None:
+            order_key = room_id
+        if label == None:
+            label = f"{event_type} {state_key} in {room_id}"
+        previous = self.tails.get(order_key)
+        task = asyncio.ensure_future(self._send(previous, room_id, event_type, content, state_key, label))
+        self.tails[order_key] = task
+        self.tasks.add(task)
+        echo_key = None
+        echo = None
+        if self.track_echoes:
+            # The echo can come in with a sync before the write returned, so expect it right away
+            echo_key = (room_id, event_type, state_key)
+            echo = [content, False]
+            self.inflight_echoes.setdefault(echo_key, []).append(echo)
+        task.add_done_callback(lambda t: self._task_done(order_key, t, echo_key, echo))
+        return task
+
+    def _task_done(self, order_key, task, echo_key, echo):
+        self.tasks.discard(task)
+        if self.tails.get(order_key) is task:
+            del self.tails[order_key]
+        if echo_key == None:
+            return
+        echoes = self.inflight_echoes[echo_key]
+        echoes.remove(echo)
+        if len(echoes) == 0:
+            del self.inflight_echoes[echo_key]
+        # No echo will come for a failed write, and a seen one does not come again
+        if not echo[1] and self.task_succeeded(task):
+            self.expected_echoes[task.result().event_id] = time.monotonic()
+
+    def is_echo(self, room_id, event_type, state_key, content, sender, event_id):
+        # Whether a state event from a sync is the result of one of our writes, each write matches once
+        self._expire_echoes()
+        if self.expected_echoes.pop(event_id, None) != None:
+            return True
+        if sender != self.client.user_id:
+            return False
+        if content == None:
+            # Removed state comes back without content
+            content = {}
+        for echo in self.inflight_echoes.get((room_id, event_type, state_key), []):
+            if not echo[1] and echo[0] == content:
+                echo[1] = True
+                return True
+        return False
+
+    def _expire_echoes(self):
+        # Ids are added in the order the writes return, so the expired ones come first
+        expired = time.monotonic() - self.echo_ttl
+        while len(self.expected_echoes) > 0:
+            event_id, returned = next(iter(self.expected_echoes.items()))
+            if returned >= expired:
+                return
+            del self.expected_echoes[event_id]
+
+    async def _acquire_token(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            if self.rate == None:
+                return
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def _send(self, previous, room_id, event_type, content, state_key, label):
+        if previous != None:
+            # Only wait for the order, a failure of the previous write is tallied there
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            backoff = 1.0
+            for attempt in range(self.max_retries + 1):
+                await self._acquire_token()
+                try:
+                    result = await self.client.room_put_state(room_id = room_id, event_type = event_type, content = content, state_key = state_key)
+                except Exception as e:
+                    result = e
+                if put_state_succeeded(result):
+                    self.succeeded += 1
+                    return result
+                if attempt == self.max_retries:
+                    break
+                if getattr(result, "status_code", None) == "M_LIMIT_EXCEEDED":
+                    retry_after_ms = getattr(result, "retry_after_ms", None)
+                    delay = retry_after_ms / 1000 if retry_after_ms else backoff
+                    self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+                elif isinstance(result, Exception):
+                    # Network trouble, try again a bit later
+                    await asyncio.sleep(backoff)
+                else:
+                    break
+                self.retried += 1
+                backoff = min(backoff * 2, 60)
+            self.failed += 1
+            self.failures.append((label, result))
+            print(f"Failed: {label}: {result}")
+            return result
+
+    def task_succeeded(self, task):
+        # For tasks returned by put_state once they are done
+        return not task.cancelled() and task.exception() == None and put_state_succeeded(task.result())
+
+    async def join(self):
+        while len(self.tasks) > 0:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    def print_summary(self):
+        print(f"Writes: {self.succeeded} succeeded, {self.retried} retries, {self.failed} failed")
+        for label, result in self.failures:
+            print(f"- {label}: {result}")